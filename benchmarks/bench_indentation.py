@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Indentation tracking benchmark.
+
+Compares the old tracker, which kept the width of each indent and summed
+them for every line, with `Indent_Stack`, on scripts of nested `:choice:`
+and `:if` blocks at increasing depths. Each line is also given its output
+indentation, built with `'    '*n` or taken from `indent_prefix`.
+
+Usage: "python benchmarks/bench_indentation.py [line_count]"
+"""
+from __future__ import print_function, unicode_literals
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import rpsb
+
+DEPTHS = (2, 5, 10, 15, 20)
+
+
+def make_widths(count, depth):
+    """Return the leading whitespace of `count` lines that repeatedly nest
+    blocks `depth` deep and then close them all at once."""
+    _widths = []
+    while len(_widths) < count:
+        for level in range(depth+1):
+            _widths.extend([level*4]*3)
+    return _widths[:count]
+
+
+def bench_sums(widths):
+    _start = time.time()
+    prev_ws = []
+    cur_indent = 0
+    for width in widths:
+        if width < sum(prev_ws):
+            _reduce = 0
+            for i in range(len(prev_ws), 0, -1):
+                if width < sum(prev_ws[:i]):
+                    _reduce += 1
+                else:
+                    break
+            cur_indent -= _reduce
+            while _reduce >= 1:
+                prev_ws.pop()
+                _reduce -= 1
+        elif width > sum(prev_ws):
+            cur_indent += 1
+            prev_ws.append(width - sum(prev_ws))
+        '    '*cur_indent
+    return time.time() - _start
+
+
+def bench_stack(widths):
+    _start = time.time()
+    _indents = rpsb.Indent_Stack()
+    for width in widths:
+        _top = _indents.widths[-1]
+        if width < _top:
+            _indents.dedent(width)
+        elif width > _top:
+            _indents.indent(width)
+        rpsb.indent_prefix(_indents.level())
+    return time.time() - _start
+
+
+def main(argv):
+    line_count = int(argv[0]) if argv else 200000
+    print("{:>8} {:>14} {:>14} {:>8}".format(
+        "depth", "sums lines/s", "stack lines/s", "speedup"))
+    for depth in DEPTHS:
+        widths = make_widths(line_count, depth)
+        _sums = bench_sums(widths)
+        _stack = bench_stack(widths)
+        print("{:>8} {:>14.0f} {:>14.0f} {:>7.1f}x".format(depth,
+            line_count/_sums, line_count/_stack, _sums/_stack))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Line replacement rule matching benchmark.
+
+Compares the old linear scan over every compiled `:line` rule with the
+combined `Rule_Set` matcher, reporting lines/sec at increasing rule counts.
+
+Usage: "python benchmarks/bench_line_rules.py [line_count]"
+"""
+from __future__ import print_function, unicode_literals
+
+import os
+import re
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import rpsb
+
+RULE_COUNTS = (10, 100, 1000, 10000)
+
+
+def make_rules(count):
+    _rules = []
+    for i in range(count):
+        if i % 4 == 0:
+            _rules.append("tr_{}_{{+}}".format(i))
+        elif i % 4 == 1:
+            _rules.append("scene_{}".format(i))
+        elif i % 4 == 2:
+            _rules.append("fx_{}(*)".format(i))
+        else:
+            _rules.append("move_{}_? to {{+}}".format(i))
+    return [rpsb.regex_prep(r) for r in _rules]
+
+
+def make_lines(count, rule_count, rng):
+    _lines = []
+    for i in range(count):
+        r = rng.random()
+        # Most lines in a script are narration and match no rule at all.
+        if r < 0.8:
+            _lines.append("Narration line number {} goes here.".format(i))
+        else:
+            n = rng.randrange(rule_count) // 4 * 4
+            _lines.append("tr_{}_{}".format(n, i))
+    return _lines
+
+
+def bench_linear(rules, lines):
+    _compiled = [(re.compile('^'+r+'$'), r) for r in rules]
+    _start = time.time()
+    for line in lines:
+        for k, v in _compiled:
+            if k.match(line):
+                break
+    return time.time() - _start
+
+
+def bench_rule_set(rules, lines):
+    _rule_set = rpsb.Rule_Set('$')
+    for r in rules:
+        _rule_set.add(r, r)
+    _start = time.time()
+    for line in lines:
+        _rule_set.match(line)
+    return time.time() - _start
+
+
+def main(argv):
+    line_count = int(argv[0]) if argv else 5000
+    rng = random.Random(0)
+    print("{:>8} {:>16} {:>16} {:>8}".format(
+        "rules", "linear lines/s", "combined lines/s", "speedup"))
+    for count in RULE_COUNTS:
+        rules = make_rules(count)
+        lines = make_lines(line_count, count, rng)
+        _linear = bench_linear(rules, lines)
+        _combined = bench_rule_set(rules, lines)
+        print("{:>8} {:>16.0f} {:>16.0f} {:>7.1f}x".format(count,
+            line_count/_linear, line_count/_combined, _linear/_combined))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Disabled logging overhead benchmark.
+
+Measures the per-line cost of the VERB messages `parse_line` emits while
+logging at INFO level, when they are formatted eagerly, deferred with
+`args`, or skipped behind a single `log.enabled_for` check.
+
+Usage: "python benchmarks/bench_logging.py [line_count]"
+"""
+from __future__ import print_function, unicode_literals
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import rpsb
+from rpsb import LOGLEVEL
+
+# The messages logged for a typical narration line.
+MESSAGES = (
+    "Performing indentation management",
+    "Checking for indentation errors",
+    "Checking for command",
+    "Checking for new indent",
+    "Checking for line replacement",
+    "Checking for character replacement",
+    "Checking for unknown command",
+    "Normal narration line",
+    "Writing line to output",
+)
+
+
+def bench_none(log, lines):
+    _start = time.time()
+    for line in lines:
+        line.strip()
+    return time.time() - _start
+
+
+def bench_eager(log, lines):
+    _start = time.time()
+    for line in lines:
+        log('Parsing Line: "{}"'.format(line.strip()), LOGLEVEL.VERB)
+        for msg in MESSAGES:
+            log(msg, LOGLEVEL.VERB)
+        line.strip()
+    return time.time() - _start
+
+
+def bench_deferred(log, lines):
+    _start = time.time()
+    for line in lines:
+        log('Parsing Line: "{}"', LOGLEVEL.VERB, args=(line,))
+        for msg in MESSAGES:
+            log(msg, LOGLEVEL.VERB)
+        line.strip()
+    return time.time() - _start
+
+
+def bench_gated(log, lines):
+    _start = time.time()
+    for line in lines:
+        _verb = log.enabled_for(LOGLEVEL.VERB)
+        if _verb:
+            log('Parsing Line: "{}"'.format(line.strip()), LOGLEVEL.VERB)
+        for msg in MESSAGES:
+            if _verb:
+                log(msg, LOGLEVEL.VERB)
+        line.strip()
+    return time.time() - _start
+
+
+def main(argv):
+    line_count = int(argv[0]) if argv else 200000
+    rpsb._debug = 0
+    log = rpsb._Logger([])
+    lines = ["    Narration line number {} goes here.\n".format(i)
+             for i in range(line_count)]
+
+    _base = bench_none(log, lines)
+    print("{:>10} {:>14}".format("mode", "ns/line"))
+    for name, func in (("eager", bench_eager), ("deferred", bench_deferred),
+                       ("gated", bench_gated)):
+        _t = func(log, lines) - _base
+        print("{:>10} {:>14.0f}".format(name, _t/line_count*1e9))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
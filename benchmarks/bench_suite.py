@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic workload benchmark suite.
+
+Builds a synthetic project (see `synthetic.py`) for each scenario and
+reports lines/sec, peak memory and the builder's `stats` counters. Every
+build runs in a fresh process, so peak memory is per scenario. Results
+are saved as JSON, and a previous results file can be given to compare
+against.
+
+Usage: "python benchmarks/bench_suite.py [-o results.json] [--compare=old.json]
+        [--scale=F] [--repeat=N] [scenario ...]"
+"""
+from __future__ import print_function, unicode_literals
+
+import io
+import os
+import sys
+import json
+import time
+import getopt
+import shutil
+import platform
+import tempfile
+import subprocess
+
+_here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_here, '..'))
+sys.path.insert(0, _here)
+import rpsb
+import synthetic
+
+# Each scenario is a set of synthetic.make_project parameters.
+SCENARIOS = {
+    "baseline": {},
+    "many_line_rules": {"line_rules": 2000},
+    "many_character_rules": {"character_rules": 2000},
+    "literal_rules": {"line_rules": 500, "character_rules": 500,
+                      "wildcards": 0.0},
+    "wildcard_rules": {"line_rules": 500, "character_rules": 500,
+                       "wildcards": 1.0},
+    "deep_imports": {"files": 2, "import_depth": 16},
+    "deep_nesting": {"nesting_depth": 8},
+    "nvl_heavy": {"nvl": 0.9},
+    "large": {"lines": 200000, "files": 20},
+}
+
+
+def peak_memory_kb():
+    """Return the peak resident memory of this process in kB, if known."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    _peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return _peak//1024
+    return _peak
+
+
+def run_build(master, result_path):
+    """Build `master` in this process and save the measurements."""
+    _stdout = sys.stdout
+    _start = time.time()
+    with open(os.devnull, 'w') as sys.stdout:
+        try:
+            rpsb.main([master])
+        except SystemExit:
+            pass
+        finally:
+            rpsb.cleanup()
+            sys.stdout = _stdout
+    _seconds = time.time()-_start
+
+    _warnings, _errors = rpsb.log.counts()
+    with io.open(result_path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({
+            "seconds": _seconds,
+            "peak_memory_kb": peak_memory_kb(),
+            "warnings": _warnings,
+            "errors": _errors,
+            "stats": dict((k, v) for k, v in rpsb.stats.items()
+                          if k != "start_time"),
+        }))
+
+
+def run_scenario(name, params, scale, repeat):
+    params = dict(params)
+    params["lines"] = int(params.get("lines", synthetic.DEFAULTS["lines"])
+                          *scale)
+    _dir = tempfile.mkdtemp(prefix='rpsb-bench-')
+    try:
+        master = synthetic.make_project(_dir, **params)
+        _result_path = os.path.join(_dir, 'result.json')
+        runs = []
+        for _ in range(repeat):
+            shutil.rmtree(os.path.join(_dir, 'out'), ignore_errors=True)
+            subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                                   '--child', master, _result_path])
+            with io.open(_result_path, encoding='utf-8') as f:
+                runs.append(json.load(f))
+    finally:
+        shutil.rmtree(_dir, ignore_errors=True)
+
+    best = min(runs, key=lambda r: r["seconds"])
+    best["params"] = dict(synthetic.DEFAULTS, **params)
+    best["lines_per_sec"] = best["stats"]["in_lines"]/best["seconds"]
+    best["runs"] = [r["seconds"] for r in runs]
+    return best
+
+
+def compare(old, new):
+    print("\nCompared to {}:".format(old.get("rpsb_version")))
+    for name, result in sorted(new["scenarios"].items()):
+        _old = old["scenarios"].get(name)
+        if not _old:
+            continue
+        _change = result["lines_per_sec"]/_old["lines_per_sec"]-1
+        print("  {:<22} {:>10.0f} -> {:>10.0f} lines/s  {:>+7.1%}".format(
+            name, _old["lines_per_sec"], result["lines_per_sec"], _change))
+
+
+def main(argv):
+    if argv[:1] == ['--child']:
+        run_build(*argv[1:])
+        return
+
+    try:
+        opts, names = getopt.gnu_getopt(argv, 'ho:', [
+            'help', 'output=', 'compare=', 'scale=', 'repeat='])
+    except getopt.GetoptError as e:
+        sys.exit(str(e))
+
+    output = 'bench_results.json'
+    old = None
+    scale = 1.0
+    repeat = 3
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            sys.exit(__doc__)
+        elif opt in ('-o', '--output'):
+            output = arg
+        elif opt == '--compare':
+            with io.open(arg, encoding='utf-8') as f:
+                old = json.load(f)
+        elif opt == '--scale':
+            scale = float(arg)
+        elif opt == '--repeat':
+            repeat = int(arg)
+
+    for name in names:
+        if name not in SCENARIOS:
+            sys.exit("Unknown scenario {}; choose from {}".format(
+                name, ', '.join(sorted(SCENARIOS))))
+
+    results = {
+        "rpsb_version": rpsb.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "scale": scale,
+        "scenarios": {},
+    }
+    print("{:<22} {:>9} {:>12} {:>11} {:>9}".format(
+        "scenario", "lines", "lines/s", "peak kB", "seconds"))
+    for name in names or sorted(SCENARIOS):
+        result = run_scenario(name, SCENARIOS[name], scale, repeat)
+        results["scenarios"][name] = result
+        print("{:<22} {:>9} {:>12.0f} {:>11} {:>9.3f}".format(
+            name, result["stats"]["in_lines"], result["lines_per_sec"],
+            result["peak_memory_kb"], result["seconds"]))
+        if result["warnings"] or result["errors"]:
+            print("    {} warnings and {} errors".format(
+                result["warnings"], result["errors"]))
+
+    with io.open(output, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(results, indent=2, sort_keys=True))
+    print("\nResults saved to {}".format(output))
+
+    if old:
+        compare(old, results)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
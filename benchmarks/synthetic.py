@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic .rps project generator.
+
+Writes a project of configurable size and shape for benchmarking: the
+number of script lines, `:line` and `:character` rules, the share of rules
+using wildcards, how deep imports and blocks are nested and the share of
+lines inside NVL blocks. The entry script is always `master.rps`.
+
+Usage: "python benchmarks/synthetic.py dest_dir [--lines=N] [--line-rules=N]
+        [--character-rules=N] [--wildcards=F] [--files=N] [--import-depth=N]
+        [--nesting-depth=N] [--nvl=F] [--seed=N]"
+"""
+from __future__ import print_function, unicode_literals
+
+import io
+import os
+import sys
+import getopt
+import random
+
+DEFAULTS = {
+    "lines": 10000,
+    "line_rules": 50,
+    "character_rules": 10,
+    "wildcards": 0.5,
+    "files": 4,
+    "import_depth": 1,
+    "nesting_depth": 2,
+    "nvl": 0.1,
+    "seed": 0,
+}
+
+WORDS = ("the", "rain", "kept", "falling", "on", "quiet", "streets", "while",
+         "she", "waited", "for", "a", "train", "that", "never", "came")
+
+
+def _sentence(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 12)))
+
+
+class _Script(object):
+    """Lines of one generated script file."""
+
+    def __init__(self, rng, params, uses):
+        self.rng = rng
+        self.params = params
+        self.uses = uses
+        self.lines = []
+
+    def add(self, indent, line):
+        self.lines.append('    '*indent+line)
+
+    def statement(self, indent):
+        """Add one line of script, picked the way a writer might."""
+        _r = self.rng.random()
+        if _r < 0.35:
+            self.add(indent, _sentence(self.rng).capitalize()+'.')
+        elif _r < 0.7 and self.uses["characters"]:
+            self.add(indent, self.rng.choice(self.uses["characters"])+' "'+
+                     _sentence(self.rng).capitalize()+'."')
+        elif _r < 0.85 and self.uses["lines"]:
+            self.add(indent, self.rng.choice(self.uses["lines"]))
+        elif _r < 0.9:
+            self.add(indent, ":s char happy")
+        elif _r < 0.95:
+            self.add(indent, "$ points += 1")
+        else:
+            self.add(indent, ":pm \"track{}.ogg\"".format(
+                self.rng.randint(0, 9)))
+
+    def block(self, indent, depth, size):
+        """Add about `size` lines, nesting blocks `depth` levels deeper."""
+        _end = len(self.lines)+size
+        while len(self.lines) < _end:
+            _left = _end-len(self.lines)
+            if depth and _left > 3 and self.rng.random() < 0.15:
+                self.add(indent, ":if points > {}:".format(
+                    self.rng.randint(0, 9)))
+                self.block(indent+1, depth-1, min(size//4, _left-3) or 1)
+                self.add(indent, ":else:")
+                self.statement(indent+1)
+            elif _left > 5 and self.rng.random() < self.params["nvl"]/4:
+                self.add(indent, ":nvl:")
+                for _ in range(4):
+                    self.statement(indent+1)
+                self.add(indent+1, ":clear")
+            else:
+                self.statement(indent)
+
+
+def _rules(rng, count, wildcards, literal, wildcard):
+    """Return `count` rule definitions and lines that use them."""
+    _defs, _uses = [], []
+    for i in range(count):
+        if rng.random() < wildcards:
+            _defs.append(wildcard[0].format(i))
+            _uses.append(wildcard[1].format(i, rng.randint(0, 99)))
+        else:
+            _defs.append(literal[0].format(i))
+            _uses.append(literal[1].format(i))
+    return _defs, _uses
+
+
+def make_project(dest, **params):
+    """Write a synthetic project to `dest` and return its entry script path.
+
+    Accepts the keys of `DEFAULTS` as keyword arguments.
+    """
+    params = dict(DEFAULTS, **params)
+    rng = random.Random(params["seed"])
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+
+    _line_defs, _line_uses = _rules(
+        rng, params["line_rules"], params["wildcards"],
+        ("cue_{0} = $ renpy.pause({0})", "cue_{0}"),
+        ("fx_{0}_{{+}} = show fx_{0} at {{}}", "fx_{0}_pos{1}"))
+    _char_defs, _char_uses = _rules(
+        rng, params["character_rules"], params["wildcards"],
+        ("c{0} = C{0}", "c{0}"),
+        ("w{0}_{{+}} = W{0}_{{}}", "w{0}_mood{1}"))
+    uses = {"lines": _line_uses, "characters": _char_uses}
+
+    # Files form chains of imports `import_depth` long, each chain imported
+    # by the master script.
+    _chains = max(1, params["files"])
+    _depth = max(1, params["import_depth"])
+    _per_file = max(1, params["lines"]//(_chains*_depth))
+
+    master = [":config output_path = ./out", ""]
+    if _line_defs:
+        master.append(":line:")
+        master.extend('    '+d for d in _line_defs)
+    if _char_defs:
+        master.append(":character:")
+        master.extend('    '+d for d in _char_defs)
+    master.append("")
+
+    for c in range(_chains):
+        master.append(":import part{}_0.rps".format(c))
+        for d in range(_depth):
+            script = _Script(rng, params, uses)
+            _labels = max(1, _per_file//40)
+            for l in range(_labels):
+                script.add(0, "::part{}_{}_{}:".format(c, d, l))
+                script.block(1, params["nesting_depth"], _per_file//_labels)
+                script.add(0, "")
+            if d+1 < _depth:
+                script.add(0, ":import part{}_{}.rps".format(c, d+1))
+            _write(os.path.join(dest, "part{}_{}.rps".format(c, d)),
+                   script.lines)
+
+    _master = os.path.join(dest, "master.rps")
+    _write(_master, master)
+    return _master
+
+
+def _write(file_path, lines):
+    with io.open(file_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines)+'\n')
+
+
+def main(argv):
+    try:
+        opts, args = getopt.gnu_getopt(argv, 'h', [
+            'help', 'lines=', 'line-rules=', 'character-rules=',
+            'wildcards=', 'files=', 'import-depth=', 'nesting-depth=',
+            'nvl=', 'seed='])
+    except getopt.GetoptError as e:
+        sys.exit(str(e))
+    if not args or ('-h', '') in opts or ('--help', '') in opts:
+        sys.exit(__doc__)
+
+    params = {}
+    for opt, arg in opts:
+        key = opt[2:].replace('-', '_')
+        params[key] = type(DEFAULTS[key])(arg)
+    print(make_project(args[0], **params))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -14,13 +14,28 @@ from builtins import str, range, object
 import os
 import sys
 import getopt
+import glob
+import multiprocessing
 import re
+import string
 import time
 import types
 import traceback
+import threading
+import atexit
 import codecs
+import hashlib
+import tempfile
+import mmap
+import json
+import base64
+import zlib
+import bisect
+import heapq
+from array import array
 from os import path
 from functools import reduce
+from collections import OrderedDict, defaultdict, deque
 
 __version__ = "0.6.2"
 __author__ = "Nathan Sullivan"
@@ -31,18 +46,38 @@ __license__ = "MIT"
 ## Globals
 ##-----------------------------------------------------------------------------
 
+_debug = 0
+
 state = {
     "master_in_file": None,
     "cur_in_file": None,
     "cur_out_file": None,
     "next_out_file": None,
     "control_file": None,
-    "open_files": set(),
-    "known_line_rep": {},
-    "known_character_rep": {},
+    "open_files": None,
+    "known_line_rep": None,
+    "known_character_rep": None,
     "file_chain": [],
     "parent_labels": set(),
-    "is_nvl_mode": False,
+    "imported": set(),
+    "manifest": None,
+    "recorders": [],
+    "file_hashes": {},
+    "input_stamps": {},
+    "parallel_builds": {},
+    "pool": None,
+    "watch": False,
+    "building": False,
+    "aborted": False,
+    "stream": None,
+    "profile": None,
+    "cprofile": None,
+    "trace": None,
+    "rule_heat": None,
+    "ir": None,
+    "preludes": None,
+    "labels": None,
+    "check": None,
 }
 
 config = {
@@ -57,7 +92,14 @@ config = {
     "output_path": ".",
     "auto_return": True,
     "abort_on_error": True,
+    "incremental_build": False,
+    "adaptive_rule_order": False,
+    "prelude_cache": False,
+    "import_once": False,
+    "check_labels": False,
+    "max_open_files": 256,
 }
+_config_defaults = dict(config)
 
 stats = {
     "in_files": 0,
@@ -69,76 +111,35 @@ stats = {
     "character_replacements": 0,
     "narration_lines": 0,
     "dialogue_lines": 0,
+    "unchanged_files": 0,
     "start_time": time.time()
 }
 
-rep_dict1 = {
-    r'\{': '\xc0',
-    r'\}': '\xc1',
-    r'\*': '\xc2',
-    r'\+': '\xc3',
-    r'\?': '\xc4',
-    r'\\': '\xc5',
-    '.': r'\.',
-    '(': r'\(',
-    ')': r'\)',
-    '[': r'\[',
-    ']': r'\]'
-}
-
-rep_dict2 = {
+# How each character of a wildcard spec is written in a regex. Wildcards and
+# capture braces become regex syntax; characters with a special meaning in
+# regexes but not in specs are escaped. Anything else is kept as it is.
+wildcard_table = dict((ord(k), v) for k, v in {
     '{': '(',
     '}': ')',
     '*': '.*?',
     '+': '.+?',
     '?': '.?',
+    '.': r'\.',
+    '(': r'\(',
+    ')': r'\)',
+    '[': r'\[',
+    ']': r'\]',
     '^': r'\^',
     '$': r'\$',
     '|': r'\|',
-    '\xc0': r'\{',
-    '\xc1': r'\}',
-    '\xc2': r'\*',
-    '\xc3': r'\+',
-    '\xc4': r'\?',
-    '\xc5': r'\\'
-}
+}.items())
+
+# A backslash escaped brace or wildcard, which stays a literal character
+wildcard_escape_re = re.compile(r'(\\[{}*+?])')
 
-rep_dict3 = {r'\{': '\xc0', r'\}': '\xc1', '\xc0': '{', '\xc1': '}'}
-
-command_list = [
-    re.compile("^:(line)\s+(.*?)\s*=\s*(.*)$"),
-    re.compile("^:(line:)$"),
-    re.compile("^:(character)\s+(.*?)\s*=\s*(.*)$"),
-    re.compile("^:(character:)$"),
-    re.compile("^:(:)\s*(\.?.*?):?$"),
-    re.compile("^:(sc)\s+(.*)$"),
-    re.compile("^:(s)\s+(.*)$"),
-    re.compile("^:(w)\s+(.*)$"),
-    re.compile("^:(p)\s+(.*?)\s+(.*)$"),
-    re.compile("^:(pm)\s+(.*)$"),
-    re.compile("^:(ps)\s+(.*)$"),
-    re.compile("^:(pa)\s+(.*)$"),
-    re.compile("^:(v)\s+(.*)$"),
-    re.compile("^:(q)\s+(.*?)\s+(.*)$"),
-    re.compile("^:(stop)\s*(.*)?$"),
-    re.compile("^:(c)\s+(.*)$"),
-    re.compile("^:(j)\s+(.*)$"),
-    re.compile("^:(r)$"),
-    re.compile("^:(r)\s+(.*)$"),
-    re.compile("^:(choice):$"),
-    re.compile("^:(if)\s+(.*?):$"),
-    re.compile("^:(elif)\s+(.*?):$"),
-    re.compile("^:(else):$"),
-    re.compile("^:(nvl):$"),
-    re.compile('^:(clear)$'),
-    re.compile("^:(import)\s+(.*)$"),
-    re.compile("^:(file)\s+(.*)$"),
-    re.compile("^:(log)\s+(0|1|2|3|4|" \
-               "VERBOSE|DEBUG|INFO|WARN|WARNING|ERROR)\s+(.*)$"),
-    re.compile("^:(config)\s+(.*?)\s*=\s*(.*)$"),
-    re.compile("^:(config:)$"),
-    re.compile("^:(break)$")
-]
+
+command_table = {}
+command_key_re = re.compile("^:(:|[^\s:]*:?)")
 
 parent_label_re = re.compile("^(\w*)\.?.*$")
 empty_line_re = re.compile("^\s*$")
@@ -180,11 +181,16 @@ class Colorama_Helper(object):
 _c = Colorama_Helper()
 
 
+def line_location(file_path, line):
+    """Return where `line` of `file_path` is, as log messages give it."""
+    return "{}|{}".format(path.basename(file_path), line)
+
+
 class Current_Line_Str(object):
     def __str__(self):
         if len(state["file_chain"]):
             _f = state["file_chain"][-1]
-            return "{}|{} ".format(_f["file_name"], _f["cur_line"])
+            return line_location(_f["file_name"], _f["cur_line"])+' '
         return '<init> '
 
     def __add__(self, other):
@@ -201,24 +207,68 @@ class Current_Line_Str(object):
 _ln = Current_Line_Str()
 
 
-class Indent_Level_Str(object):
-    def __str__(self):
-        if state["is_nvl_mode"] is False:
-            return '    '*state["file_chain"][-1]["cur_indent"]
-        return '    '*(state["file_chain"][-1]["cur_indent"]-1)
+class Indent_Stack(object):
+    """The indentation of a file being read.
 
-    def __add__(self, other):
-        if issubclass(type(other), (str, str)):
-            return str(self)+other
-        raise TypeError("unsupported operand type(s) for +:"
-            " 'str' and '{}'".format(type(other).__name__))
+    Keeps the leading whitespace of each open block as a stack of cumulative
+    widths, so a line is placed by comparing it with the top of the stack
+    and indenting or dedenting only costs the levels it opens or closes.
 
-    def __radd__(self, other):
-        if issubclass(type(other), (str, str)):
-            return other+str(self)
-        raise TypeError("unsupported operand type(s) for +:"
-            " '{}' and 'str'".format(type(other).__name__))
-_il = Indent_Level_Str()
+    An `:nvl:` block is marked by the depth of the line opening it; the
+    block and everything nested in it is NVL, until a line dedents back to
+    that depth. NVL lines are written one level shallower. A file imported
+    from an NVL block is NVL throughout.
+    """
+
+    __slots__ = ('widths', 'nvl')
+
+    def __init__(self, nvl=None):
+        self.widths = [0]
+        self.nvl = nvl
+
+    def depth(self):
+        return len(self.widths)-1
+
+    def indent(self, width):
+        self.widths.append(width)
+
+    def dedent(self, width):
+        """Close the blocks `width` is outside of. Returns False if it
+        doesn't line up with the block it's left in."""
+        _widths = self.widths
+        while width < _widths[-1]:
+            _widths.pop()
+        if self.nvl is not None and len(_widths)-1 <= self.nvl:
+            self.nvl = None
+        return width == _widths[-1]
+
+    def open_nvl(self):
+        self.nvl = len(self.widths)-1
+
+    def level(self):
+        """Return the indent level output is written at."""
+        if self.nvl is None:
+            return len(self.widths)-1
+        return max(0, len(self.widths)-2)
+
+
+# The indentation of each output level, extended as deeper levels are used
+indent_prefixes = ['    '*i for i in range(16)]
+
+
+def indent_prefix(level):
+    try:
+        return indent_prefixes[level]
+    except IndexError:
+        while len(indent_prefixes) <= level:
+            indent_prefixes.append('    '*len(indent_prefixes))
+        return indent_prefixes[level]
+
+
+def nvl_mode():
+    """Return whether the line being parsed is in an NVL block."""
+    _chain = state["file_chain"]
+    return bool(_chain) and _chain[-1]["indents"].nvl is not None
 
 
 class LOGLEVEL(object):
@@ -238,12 +288,124 @@ LOGLEVEL = LOGLEVEL()
 ## Logger
 ##-----------------------------------------------------------------------------
 
-_tmp_log = []
+# Messages logged before the logger is set up. Only the latest are kept, in
+# case it never is, like when rpsb is imported as a module.
+_tmp_log = deque(maxlen=4096)
+
+
+def format_log_record(cur_time, level, msg):
+    return "<{0[3]:0>2n}:{0[4]:0>2n}:{0[5]:0>2n}> [{1:<6} {2}\n".format(
+        time.localtime(cur_time), LOGLEVEL[level]+']', msg)
+
+
+# Sinks with a running thread, closed at exit so no records are lost
+_running_sinks = set()
+
+
+@atexit.register
+def _close_sinks():
+    for _sink in list(_running_sinks):
+        _sink.close()
+
+
+class Log_Sink(object):
+    """Writes log records to the log file on a background thread.
+
+    Records are handed over on a deque, which needs no locking, and the
+    thread formats them and writes them out through a single open handle
+    once `flush_size` characters are waiting or `flush_interval` seconds
+    have passed. `flush` waits until everything logged so far is written.
+    `close` also stops the thread; the next record starts it again,
+    appending to the file.
+    """
+
+    def __init__(self, file_path, flush_size=64*1024, flush_interval=1.0):
+        self.file_path = file_path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.__mode = 'w'
+        self.__records = deque()
+        self.__waiting = 0
+        self.__wake = threading.Event()
+        self.__thread = None
+
+    def write(self, cur_time, level, msg):
+        if self.__thread is None:
+            self.__start()
+        self.__records.append((cur_time, level, msg))
+        self.__waiting += len(msg)
+        if self.__waiting >= self.flush_size:
+            self.__waiting = 0
+            self.__wake.set()
+
+    def __start(self):
+        _file = open(self.file_path, self.__mode)
+        self.__mode = 'a'
+        _running_sinks.add(self)
+        self.__thread = threading.Thread(target=self.__run, name="rpsb-log",
+                                         args=(_file,))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __run(self, file):
+        _records = self.__records
+        _stop = False
+        with file:
+            while not _stop:
+                self.__wake.wait(self.flush_interval)
+                self.__wake.clear()
+                _lines = []
+                _done = []
+                while _records:
+                    _record = _records.popleft()
+                    if type(_record) is tuple:
+                        _lines.append(format_log_record(*_record))
+                    elif _record is None:
+                        _stop = True
+                    else:
+                        _done.append(_record)
+                if _lines:
+                    file.writelines(_lines)
+                    file.flush()
+                for _event in _done:
+                    _event.set()
+
+    def flush(self):
+        if self.__thread is None:
+            return
+        _done = threading.Event()
+        self.__records.append(_done)
+        self.__wake.set()
+        while not _done.wait(self.flush_interval):
+            if not self.__thread.is_alive():
+                break
+
+    def close(self):
+        if self.__thread is None:
+            return
+        self.__records.append(None)
+        self.__wake.set()
+        self.__thread.join()
+        self.__thread = None
+        self.__waiting = 0
+        _running_sinks.discard(self)
+
 
 class _Logger(object):
 
-    def __init__(self, tmp_log, flush_number=10):
-        if _debug == 2:
+    def __init__(self, tmp_log, flush_size=64*1024, flush_interval=1.0,
+                 quiet=False, file_path=None, save=True, keep=False):
+        self.quiet = quiet
+        if quiet and (not keep or not _debug):
+            # Only count warnings and errors, for worker processes
+            self.log_save_level = LOGLEVEL.WARN
+            self.log_display_level = LOGLEVEL.ERROR+1
+        elif quiet:
+            # Keep debug messages, but never print them
+            self.log_save_level = (LOGLEVEL.VERB if _debug == 2
+                                   else LOGLEVEL.DEBUG)
+            self.log_display_level = LOGLEVEL.ERROR+1
+        elif _debug == 2:
             self.log_save_level = LOGLEVEL.VERB
             self.log_display_level = LOGLEVEL.DEBUG
         elif _debug == 1:
@@ -255,20 +417,21 @@ class _Logger(object):
 
         self.__errors = 0
         self.__warnings = 0
+        self.last_error = None
+        # Every warning and error, as (level, message) pairs
+        self.problems = []
+        # With `keep`, every message logged, as (level, message) pairs
+        self.records = [] if keep else None
+
+        if file_path is None:
+            _file, _ = path.splitext(path.basename(__file__))
+            file_path = _file+'.log'
+        self.__sink = None if quiet or not save else Log_Sink(
+            file_path, flush_size, flush_interval)
 
-        self.__log = []
-        self.__log_flush_number = flush_number
-        self.__log_count = 0
-        _file, _ = path.splitext(path.basename(__file__))
-        self.__log_file = _file+'.log'
-
-        _log = []
         for val in tmp_log:
-            if val['level'] >= self.log_save_level:
-                log_string = ("<{0[3]:0>2n}:{0[4]:0>2n}:{0[5]:0>2n}>"
-                    " [{1:<6} {2}\n".format(time.localtime(val['time']),
-                    LOGLEVEL[val['level']]+']', val['message']))
-                _log.append(log_string)
+            if val['level'] >= self.log_save_level and self.__sink:
+                self.__sink.write(val['time'], val['level'], val['message'])
 
             if LOGLEVEL.ERROR > val['level'] >= self.log_display_level:
                 print(_c[val['level']]+"[{:<6} {}".format(
@@ -278,58 +441,72 @@ class _Logger(object):
                 self.__warnings += 1
             elif val['level'] >= LOGLEVEL.ERROR:
                 self.__errors += 1
-
-        if _log:
-            try:
-                with open(self.__log_file, 'w') as f:
-                    f.writelines(_log)
-            except IOError:
-                raise
-                # log("Unable to open log file for writing.", LOGLEVEL.ERROR)
-
-    def __call__(self, msg, level=LOGLEVEL.INFO, exit=1):
-        if level >= self.log_save_level:
-            self.__log_count += 1
-        else:
+            if val['level'] >= LOGLEVEL.WARN:
+                self.problems.append((val['level'], val['message']))
+            if self.records is not None and \
+                    val['level'] >= self.log_save_level:
+                self.records.append((val['level'], val['message']))
+
+    def __call__(self, msg, level=LOGLEVEL.INFO, exit=1, args=None,
+                 where=None):
+        """Log `msg` at `level`.
+
+        Nothing is done for messages below `log_save_level`, so formatting
+        can be deferred by passing the format arguments as `args` or by
+        passing a callable that returns the message. Messages are prefixed
+        with the file and line being parsed, or with `where` if given.
+        """
+        if level < self.log_save_level:
             return
 
-        cur_time = time.time()
-        msg = _ln+str(msg)
-        self.__log.append({'time': cur_time, 'level': level, 'message': msg})
+        msg = (where+' ' if where else _ln)+_format_msg(msg, args)
+        if self.__sink:
+            self.__sink.write(time.time(), level, msg)
+        if self.records is not None:
+            self.records.append((level, msg))
 
         if level == LOGLEVEL.WARN:
             self.__warnings += 1
         elif level >= LOGLEVEL.ERROR:
             self.__errors += 1
+            self.last_error = msg
+        if level >= LOGLEVEL.WARN:
+            self.problems.append((level, msg))
 
         if LOGLEVEL.ERROR > level >= self.log_display_level:
             print(_c[level]+"[{:<6} {}".format(LOGLEVEL[level]+']', msg)+_c.r)
 
         elif level >= LOGLEVEL.ERROR:
-            print(_c[level]+"[{:<6} {}".format(LOGLEVEL[level]+']', msg)+_c.r)
+            if not self.quiet:
+                print(_c[level]+"[{:<6} {}".format(LOGLEVEL[level]+']', msg)
+                      +_c.r)
+            self.flush()
             if exit and config["abort_on_error"]:
                 sys.exit(exit)
 
-        if self.__log_count >= self.__log_flush_number:
-            self.flush()
+    def counts(self):
+        """Return the number of warnings and errors logged so far."""
+        return self.__warnings, self.__errors
+
+    def reset_counts(self):
+        """Start counting warnings and errors again, for a new build."""
+        self.__warnings = 0
+        self.__errors = 0
+        self.problems = []
+        if self.records is not None:
+            self.records = []
+
+    def enabled_for(self, level):
+        """Return True if a message at `level` would be logged.
+
+        Lets hot paths skip building log messages altogether.
+        """
+        return level >= self.log_save_level
 
     def flush(self):
-        _log = []
-        for l in self.__log:
-            if l['level'] >= self.log_save_level:
-                log_string = ("<{0[3]:0>2n}:{0[4]:0>2n}:{0[5]:0>2n}>"
-                    " [{1:<6} {2}\n".format(time.localtime(l['time']),
-                    LOGLEVEL[l['level']]+']', l['message']))
-                _log.append(log_string)
-
-        if _log:
-            try:
-                with open(self.__log_file, 'a') as f:
-                    f.writelines(_log)
-                self.__log = []
-            except IOError:
-                raise
-                # log("Unable to open log file for writing.", LOGLEVEL.ERROR)
+        """Wait until everything logged so far is in the log file."""
+        if self.__sink:
+            self.__sink.flush()
 
     def log_traceback(self, exit_code=1):
         _tb = '\n>>> '.join(traceback.format_exc().split('\n')[:-1])
@@ -358,7 +535,8 @@ class _Logger(object):
             "line_replacements",
             "character_replacements",
             "narration_lines",
-            "dialogue_lines"
+            "dialogue_lines",
+            "unchanged_files"
         )
         for k in _stats_list:
             _pretty_log(k)
@@ -370,6 +548,13 @@ class _Logger(object):
         _run_time = cur_time - stats["start_time"]
         _log.append("    {:>19} : {}".format("total_run_time", _s(_run_time)))
 
+        if state["profile"]:
+            _log.extend(state["profile"].report())
+        if state["known_line_rep"] is not None:
+            _log.extend(rule_report(state["known_line_rep"], "Line"))
+            _log.extend(rule_report(state["known_character_rep"],
+                                    "Character"))
+
         log('\n'.join(_log))
 
     def close(self):
@@ -384,11 +569,20 @@ class _Logger(object):
                 LOGLEVEL.INFO)
 
         self.stats(time.time())
-        self.flush()
+        if self.__sink:
+            self.__sink.close()
+
 
+def _format_msg(msg, args=None):
+    if callable(msg):
+        msg = msg()
+    if args:
+        return str(msg).format(*args)
+    return str(msg)
 
-def log(msg, level=LOGLEVEL.INFO, exit=True):
-    msg = _ln+msg
+
+def log(msg, level=LOGLEVEL.INFO, exit=True, args=None, where=None):
+    msg = (where+' ' if where else _ln)+_format_msg(msg, args)
     _tmp_log.append({'time': time.time(), 'level': level, 'message': msg})
     if level >= LOGLEVEL.ERROR:
         if exit and config["abort_on_error"]:
@@ -402,17 +596,210 @@ def _log_close(*args, **kwargs):
 log.close = _log_close
 
 
+def _log_enabled_for(level):
+    # Everything is kept until the logger knows what level to save at.
+    return True
+log.enabled_for = _log_enabled_for
+
+
 def _log_traceback(exit_code=1):
     _tb = "\n        ".join(traceback.format_exc().split('\n'))
     log("Traceback:\n        {}".format(_tb),
         LOGLEVEL.ERROR, exit = exit_code)
 log.log_traceback = _log_traceback
 
+##-----------------------------------------------------------------------------
+## Profiling
+##-----------------------------------------------------------------------------
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class Phase_Timer(object):
+    """Splits the build time between the phases of a build, per input file.
+
+    The build is always in exactly one phase. `switch` charges the time
+    since the last switch to the phase being left, so the time of a phase
+    never includes the phases it calls into:
+
+        input            reading input files
+        parse            everything in parse_line not covered below
+        indent           indentation tracking
+        commands         matching and running commands
+        line_rules       matching line replacements
+        character_rules  matching character replacements
+        write            writing lines and flow control label calls
+        output           writing the output files to disk
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.file = None
+        self.phase = "parse"
+        self.last = _clock()
+        self.set_file(None)
+
+    def switch(self, phase):
+        """Switch to `phase`, returning the phase being left."""
+        _now = _clock()
+        self.times[self.phase] += _now-self.last
+        self.calls[phase] += 1
+        _old, self.phase, self.last = self.phase, phase, _now
+        return _old
+
+    def set_file(self, file_path):
+        """Charge time to `file_path` from now on, returning the file time
+        was charged to until now."""
+        if self.file in self.files:
+            self.switch(self.phase)
+            self.calls[self.phase] -= 1
+        _old, self.file = self.file, file_path
+        if file_path not in self.files:
+            self.files[file_path] = (defaultdict(float), defaultdict(int))
+        self.times, self.calls = self.files[file_path]
+        self.calls[self.phase] += 1
+        return _old
+
+    def stop(self):
+        """Charge the time since the last switch to the current phase, at
+        the end of the build. No phase is switched to after this."""
+        if self.last is not None:
+            self.times[self.phase] += _clock()-self.last
+            self.last = None
+
+    def results(self):
+        """Return the time and number of calls of each phase, in total and
+        per input file, as of the last switch."""
+        _phases = {}
+        _files = {}
+        for file, (times, calls) in self.files.items():
+            file = file.replace(os.getcwd(), '.') if file else "<build>"
+            for phase, t in times.items():
+                _total = _phases.setdefault(phase, {"seconds": 0.0,
+                                                    "calls": 0})
+                _total["seconds"] += t
+                _total["calls"] += calls[phase]
+                _files.setdefault(file, {})[phase] = {"seconds": t,
+                                                      "calls": calls[phase]}
+        return {"phases": _phases, "files": _files}
+
+    def report(self, results=None):
+        """Return lines for the build statistics."""
+        results = results or self.results()
+        _total = sum(p["seconds"] for p in results["phases"].values()) or 1
+        _log = ["Time by phase:"]
+        for phase, p in sorted(results["phases"].items(),
+                               key=lambda i: -i[1]["seconds"]):
+            _log.append("    {:>19} : {:>8.3f}s {:>6.1%}".format(
+                phase, p["seconds"], p["seconds"]/_total))
+        _log.append("Time by input file:")
+        _files = sorted(((sum(p["seconds"] for p in f.values()), file)
+                         for file, f in results["files"].items()),
+                        reverse=True)
+        for t, file in _files[:10]:
+            _log.append("    {:>8.3f}s {:>6.1%} {}".format(t, t/_total, file))
+        if len(_files) > 10:
+            _log.append("    ... and {} more in the profile".format(
+                len(_files)-10))
+        return _log
+
+
+class Build_Trace(object):
+    """A timeline of the build, saved in the Chrome trace event format that
+    Perfetto and chrome://tracing open.
+
+    Spans opened with `begin` are closed by `end` in reverse order, and
+    become complete ("X") events, nested by time. There are spans for each
+    build, each `:import`, each input file read (with the chain of files
+    importing it), opening output files, writing out compiled statements,
+    writing output files to disk and compiling rule tables. Spans still
+    open when the trace is saved, like after an error, end there.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.events = []
+        self.spans = []
+        self.pid = os.getpid()
+        self.start = _clock()
+
+    def begin(self, name, cat, args=None):
+        self.spans.append((name, cat, args, _clock()))
+
+    def end(self, args=None):
+        _now = _clock()
+        name, cat, _args, start = self.spans.pop()
+        _event = {"name": name, "cat": cat, "ph": "X", "pid": self.pid,
+                  "tid": 0, "ts": (start-self.start)*1e6,
+                  "dur": (_now-start)*1e6}
+        if _args or args:
+            _event["args"] = dict(_args or {}, **(args or {}))
+        self.events.append(_event)
+
+    def note(self, **args):
+        """Add `args` to the innermost open span."""
+        name, cat, _args, start = self.spans[-1]
+        self.spans[-1] = (name, cat, dict(_args or {}, **args), start)
+
+    def save(self):
+        while self.spans:
+            self.end()
+        try:
+            with open(self.file_path, 'w') as f:
+                json.dump({"traceEvents": self.events,
+                           "displayTimeUnit": "ms",
+                           "otherData": {"version": __version__}}, f)
+        except (IOError, OSError):
+            log("Unable to save the build trace", LOGLEVEL.WARN)
+        else:
+            log("Build trace saved to {}", LOGLEVEL.INFO,
+                args=(self.file_path,))
+
+
+def trace_name(file_path):
+    return file_path.replace(os.getcwd(), '.')
+
+
+def profile_path(extension):
+    _file, _ = path.splitext(path.basename(__file__))
+    return _file+extension
+
+
+def save_profile():
+    """Save the profile of the build, if it is being profiled."""
+    if state["profile"]:
+        _results = state["profile"].results()
+        _results["rules"] = {}
+        for rule_set in (state["known_line_rep"],
+                         state["known_character_rep"]):
+            _results["rules"][rule_set.kind] = [{
+                "rule": rule_set.sources.get(regex, regex),
+                "regex": regex,
+                "hits": hits,
+                "attempts": attempts,
+                "seconds": seconds,
+            } for regex, (hits, attempts, seconds)
+                in rule_set.rule_stats().items()]
+        try:
+            with open(profile_path('.profile.json'), 'w') as f:
+                json.dump(_results, f, indent=2, sort_keys=True)
+        except (IOError, OSError):
+            log("Unable to save the build profile", LOGLEVEL.WARN)
+        else:
+            log("Build profile saved to {}", LOGLEVEL.INFO,
+                args=(profile_path('.profile.json'),))
+    if state["cprofile"]:
+        state["cprofile"].disable()
+        state["cprofile"].dump_stats(profile_path('.pstats'))
+        log("cProfile stats saved to {}", LOGLEVEL.INFO,
+            args=(profile_path('.pstats'),))
+
 ##-----------------------------------------------------------------------------
 ## Misc Functions
 ##-----------------------------------------------------------------------------
 
-def setup_globals(output_path=None, flush_number=10):
+def setup_globals(output_path=None, flush_size=64*1024, flush_interval=1.0,
+                  save_log=True):
     global log, _tmp_log
     log("Initializing Globals", LOGLEVEL.DEBUG)
 
@@ -424,15 +811,41 @@ def setup_globals(output_path=None, flush_number=10):
     config["output_path"] = output_path
 
     log("initializing logger", LOGLEVEL.DEBUG)
-    log = _Logger(_tmp_log, flush_number)
+    log = _Logger(_tmp_log, flush_size, flush_interval, save=save_log)
     del _tmp_log
 
-    config["flow_control_ignore"] = [
+    state["known_line_rep"] = Rule_Set('$')
+    state["known_character_rep"] = Character_Rule_Set()
+    state["ir"] = Script_IR()
+    state["open_files"] = File_Registry()
+    state["labels"] = Label_Table()
+
+    config["flow_control_ignore"] = default_flow_control_ignore()
+
+
+def default_flow_control_ignore():
+    return [
         re.compile('^'+regex_prep("*_choice*")+'$'),
         re.compile('^'+regex_prep("*_ignore*")+'$')
     ]
 
 
+_flow_control_ignore = [None, None]
+
+
+def flow_control_ignore_re():
+    """Return one regex matching every label in `flow_control_ignore`, or
+    None if there are none."""
+    _patterns = config["flow_control_ignore"]
+    if _flow_control_ignore[0] is not _patterns:
+        _re = None
+        if _patterns:
+            _re = cached_regex('|'.join(['(?:{})'.format(r.pattern)
+                                         for r in _patterns]))
+        _flow_control_ignore[:] = [_patterns, _re]
+    return _flow_control_ignore[1]
+
+
 def total(itter):
     _sum = 0
     for i in itter:
@@ -440,13 +853,59 @@ def total(itter):
     return _sum
 
 
-def fix_brace(matchobj):
-    _m = matchobj.group(0)
-    if _m in rep_dict3:
-        return rep_dict3[_m]
-    else:
-        log("Failed to match {}".format(_m), LOGLEVEL.WARN)
-        return _m
+def file_hash(file_path, size=None):
+    """Return the sha1 hex digest of the file at `file_path`.
+
+    Returns None if the file doesn't exist, or if `size` is given and the
+    file is a different size, as then it can't possibly match.
+    """
+    try:
+        if size is not None and path.getsize(file_path) != size:
+            return None
+        _hash = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                _hash.update(chunk)
+    except (IOError, OSError):
+        return None
+    return _hash.hexdigest()
+
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def file_stamp(file_path):
+    """Return the modification time and size of a file, or None."""
+    try:
+        _stat = os.stat(file_path)
+    except OSError:
+        return None
+    return getattr(_stat, 'st_mtime_ns', _stat.st_mtime), _stat.st_size
+
+
+def input_hash(file_path):
+    """Return the hash of an input file, only reading it once per build."""
+    try:
+        return state["file_hashes"][file_path]
+    except KeyError:
+        state["input_stamps"][file_path] = file_stamp(file_path)
+        state["file_hashes"][file_path] = file_hash(file_path)
+        return state["file_hashes"][file_path]
+
+
+def replace_file(src, dst):
+    """Atomically move `src` over `dst`."""
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        # Python 2 has no os.replace and os.rename won't overwrite on Windows
+        if os.name == 'nt' and path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
 
 
 def usage(error=None, exit_code=None):
@@ -459,13 +918,42 @@ def usage(error=None, exit_code=None):
     print("::   Ren'Py Script Builder")
     print('::'+("-"*77))
     print('\n  Usage:')
-    print('    {} -h|source [-o:dir] [--flush=value]' \
+    print('    {} -h|source [source ...] [-o:dir] [-j:jobs] [--watch]'
+          ' [--check] [--profile[=cprofile]] [--trace=file]'
           ' [--debug|--verbose]\n\n'.format(path.basename(__file__)))
     print("   {:>16} :: Print this help message\n".format('[-h|--help]'))
+    print("   {:>16} :: The script file(s) to build. Several files, or".format(
+        'source'))
+    print((" "*20)+"::  globs like routes/*.rps, are each built on their")
+    print((" "*20)+"::  own, on as many processes as -j allows.\n")
     print("   {:>16} :: Set the output directory".format('[-o:<dir>]'))
     print("   {:>16} :: NOTE: Output directory may be overwritten by config" \
         .format('[--output=<dir>]'))
-    print((" "*20)+"::  options set in the source file.\n")
+    print((" "*20)+"::  options set in the source file. With several")
+    print((" "*20)+"::  source files, each one's output goes to a")
+    print((" "*20)+"::  directory named after it within <dir>.\n")
+    print("   {:>16} :: Compile the files imported by the source file".format(
+        '[-j:<jobs>]'))
+    print("   {:>16} :: on this many processes. 0 uses every CPU.".format(
+        '[--jobs=<jobs>]'))
+    print((" "*20)+"::  With several source files, build that many of")
+    print((" "*20)+"::  them at once instead (every CPU by default).\n")
+    print("   {:>16} :: Keep running and rebuild whenever a source".format(
+        '[--watch]'))
+    print((" "*20)+"::  file changes.\n")
+    print("   {:>16} :: Check that the output files are up to date".format(
+        '[--check]'))
+    print((" "*20)+"::  without writing anything; fails listing the")
+    print((" "*20)+"::  files that aren't.\n")
+    print("   {:>16} :: Time each phase of the build and save the".format(
+        '[--profile]'))
+    print((" "*20)+"::  results to rpsb.profile.json.")
+    print("   {:>16} :: Profile the build with cProfile and save".format(
+        '[--profile=cprofile]'))
+    print((" "*20)+"::  the stats to rpsb.pstats.\n")
+    print("   {:>16} :: Save a timeline of the build to <file>, to".format(
+        '[--trace=<file>]'))
+    print((" "*20)+"::  open in Perfetto or chrome://tracing.\n")
     print("   {:>16} :: Print this help message\n".format('[-h|--help]'))
     print("   {:>16} :: Set logging level to debug".format('[--debug]'))
     print("   {:>16} :: Set logging level to verbose.".format('[--verbose]'))
@@ -481,65 +969,1011 @@ def usage(error=None, exit_code=None):
 ## Regex manager
 ##-----------------------------------------------------------------------------
 
+_prep_cache = {}
+
+
 def regex_prep(string):
-    log("Preping string for regex: {}".format(string), LOGLEVEL.VERB)
+    """Translate the wildcard spec `string` into a regex.
 
-    def _re1(matchobj):
-        _m = matchobj.group(0)
-        if _m in rep_dict1:
-            return rep_dict1[_m]
-        else:
-            log("Failed to match {}".format(_m), LOGLEVEL.WARN)
-            return _m
+    Escaped wildcards are split out and kept as they are, and the text
+    around them is translated through `wildcard_table`, so the spec is
+    only scanned once. Results are cached, as the same specs are prepared
+    again by every build.
+    """
+    try:
+        return _prep_cache[string]
+    except KeyError:
+        pass
+    _parts = wildcard_escape_re.split(string.strip())
+    # Every odd part is an escape
+    _parts[::2] = [p.translate(wildcard_table) for p in _parts[::2]]
+    if len(_prep_cache) >= 8192:
+        _prep_cache.clear()
+    _prep_cache[string] = ''.join(_parts)
+    return _prep_cache[string]
+
+
+_regex_cache = {}
 
-    def _re2(matchobj):
-        _m = matchobj.group(0)
-        if _m in rep_dict2:
-            return rep_dict2[_m]
-        else:
-            log("Failed to match {}".format(_m), LOGLEVEL.WARN)
-            return _m
 
-    string = string.strip()
-    _s = re.sub('\\\\{|\\\\}|\\\\\*|\\\\\+|'
-                '\\\\\?|\.|\(|\)|\[|\]', _re1, string)
-    return re.sub('\{|\}|\*|\+|\?|\^|\$|\||'
-                  '\xc0|\xc1|\xc2|\xc3|\xc4|\xc5', _re2, _s)
+def cached_regex(pattern):
+    """Compile `pattern`, reusing the result for every later build.
+
+    The re module's own cache only holds a few hundred patterns, fewer than
+    a large script defines rules, so in watch mode we keep our own.
+    """
+    try:
+        return _regex_cache[pattern]
+    except KeyError:
+        if len(_regex_cache) >= 8192:
+            _regex_cache.clear()
+        _regex_cache[pattern] = re.compile(pattern)
+        return _regex_cache[pattern]
+
+
+class Replacement_Template(object):
+    """A rule's replacement, compiled into literal chunks and the groups
+    that go between them, so rendering a match is a single join.
+
+    Placeholders are those of `str.format`: `{}` for the next group or
+    `{0}` for a numbered one, optionally with a conversion and format spec,
+    and `{{` or `}}` for a brace. A backslash escaped brace is a brace too.
+    A replacement can be made of several `texts` numbered as one, as
+    character rules are; `render` can put a prefix and suffix around the
+    first of them.
+    """
+
+    __slots__ = ('chunks', 'fields', 'groups', 'used', 'first_end')
+    escape_re = re.compile(r'(\\[{}])')
+    formatter = string.Formatter()
+
+    def __init__(self, texts):
+        # Chunk 0 and first_end are left empty for a prefix and suffix
+        self.chunks = ['']
+        self.fields = []
+        self.first_end = None
+        _literal = []
+        _auto = 0
+        _numbered = False
+        for n, text in enumerate(texts):
+            for i, part in enumerate(self.escape_re.split(text)):
+                if i % 2:
+                    _literal.append(part[1])
+                    continue
+                for literal, name, spec, conversion in \
+                        self.formatter.parse(part):
+                    _literal.append(literal)
+                    if name is None:
+                        continue
+                    if name == '' and not _numbered:
+                        _group = _auto
+                        _auto += 1
+                    elif name.isdigit() and not _auto:
+                        _group = int(name)
+                        _numbered = True
+                    elif name == '' or name.isdigit():
+                        raise ValueError("can't mix {} and {0} placeholders")
+                    else:
+                        raise ValueError("unknown placeholder {{{}}}".format(
+                            name))
+                    _format = None
+                    if spec or conversion:
+                        _format = '{0'+('!'+conversion if conversion else '')
+                        _format += (':'+spec if spec else '')+'}'
+                    self.chunks.append(''.join(_literal))
+                    _literal = []
+                    self.fields.append((len(self.chunks), _group, _format))
+                    self.chunks.append('')
+            if n == 0:
+                self.chunks.append(''.join(_literal))
+                _literal = []
+                self.first_end = len(self.chunks)
+                self.chunks.append('')
+        self.chunks.append(''.join(_literal))
+        _groups = [f[1] for f in self.fields]
+        # The number of groups needed, and how many of those are used
+        self.groups = max(_groups)+1 if _groups else 0
+        self.used = len(set(_groups))
+
+    @classmethod
+    def literal(cls, texts):
+        """Return a template writing `texts` as they are."""
+        return cls([t.replace('{', '{{').replace('}', '}}') for t in texts])
+
+    def render(self, groups, prefix=None, suffix=None):
+        _chunks = self.chunks[:]
+        for i, group, _format in self.fields:
+            if _format is None:
+                _chunks[i] = groups[group]
+            else:
+                _chunks[i] = _format.format(groups[group])
+        if prefix is not None:
+            _chunks[0] = prefix
+            _chunks[self.first_end] = suffix
+        return ''.join(_chunks)
+
+
+_template_cache = {}
+
+
+def replacement_template(replace):
+    """Compile `replace`, a string or tuple of strings, into a
+    `Replacement_Template`. Raises ValueError if it is malformed."""
+    try:
+        return _template_cache[replace]
+    except KeyError:
+        pass
+    _template = Replacement_Template(
+        replace if isinstance(replace, tuple) else (replace,))
+    if len(_template_cache) >= 8192:
+        _template_cache.clear()
+    _template_cache[replace] = _template
+    return _template
+
+
+# Python 2 regexes can have at most 100 groups, counting the whole match
+_max_groups = 99
+
+
+class Rule_Bucket(object):
+    """The combined regexes for the rules that can match lines starting with
+    one character, with counters of what they matched.
+
+    `chunks` is a list of `(regex, index)` pairs, tried in order, each one
+    combining as many consecutive rules as fit under the group limit.
+    """
+
+    __slots__ = ('chunks', 'rules', 'hits', 'hit_time', 'misses',
+                 'miss_time')
+
+    def __init__(self, chunks, rules):
+        self.chunks = chunks
+        self.rules = rules
+        self.hits = [0]*len(rules)
+        self.hit_time = [0.0]*len(rules)
+        self.misses = 0
+        self.miss_time = 0.0
+
+    def fold(self, totals):
+        """Add the hits, attempts and time of each rule to `totals`.
+
+        A line is tried against every rule up to the one it matched, so a
+        rule's attempts are the misses plus the hits of the rules after it.
+        The time of a match can't be split between the rules it tried, so
+        each of them is charged an equal share.
+        """
+        _attempts = self.misses
+        _time = self.miss_time/len(self.rules)
+        for i in range(len(self.rules)-1, -1, -1):
+            _attempts += self.hits[i]
+            _time += self.hit_time[i]/(i+1)
+            _t = totals.setdefault(self.rules[i], [0, 0, 0.0])
+            _t[0] += self.hits[i]
+            _t[1] += _attempts
+            _t[2] += _time
+
+
+class Rule_Set(object):
+    """An ordered set of replacement rules matched with one combined regex.
+
+    Rules are joined into a single alternation, so a line takes one match
+    attempt no matter how many rules are defined. The regex engine tries the
+    alternatives in order, which keeps the first defined rule winning when
+    several could match. Each alternative ends in an empty marker group, so
+    `lastindex` of a match tells us which rule it came from. Python 2 only
+    allows 100 groups in a regex, so rules that need more than that are
+    split into several alternations, tried one after the other.
+
+    Rules are also partitioned by the literal character they must start
+    with, and a line is only ever tried against the alternation built for
+    its own first character. Redefining a rule replaces it in place, keeping
+    its original position.
+
+    With `adaptive_rule_order` set, rules that were hit most in previous
+    builds are moved forward in the alternation, past any rules that can
+    never match the same line as them.
+    """
+
+    kind = "line"
+
+    def __init__(self, suffix=''):
+        self.suffix = suffix
+        self.definitions = OrderedDict()
+        self.rules = OrderedDict()
+        self.sources = {}
+        self.__totals = {}
+        self.__buckets = {}
+        self.__digest = None
+
+    def __len__(self):
+        return len(self.definitions)
+
+    def add(self, regex, replace, source=None):
+        self.definitions[regex] = replace
+        if source is not None:
+            self.sources[regex] = source
+        self.__digest = None
+        self.index(regex, replace)
+
+    def digest(self):
+        """Return a hash of every rule definition, in order."""
+        if self.__digest is None:
+            self.__digest = hashlib.sha1(json.dumps(
+                list(self.definitions.items())).encode('utf-8')).hexdigest()
+        return self.__digest
+
+    def index(self, regex, replace):
+        # Compiling the rule on its own catches bad patterns at definition
+        # time and tells us how many groups it adds to the combined regex.
+        _groups = cached_regex('^'+regex+self.suffix).groups
+        self.rules[regex] = (self.template(regex, replace, _groups), _groups,
+                             self.literal_head(regex))
+        self.reset_buckets()
+
+    def template(self, regex, replace, groups):
+        """Compile the replacement of a rule whose pattern captures `groups`
+        groups, checking it uses each of them."""
+        try:
+            _template = replacement_template(replace)
+        except ValueError as e:
+            log("Invalid replacement for {} rule {}: {}", LOGLEVEL.ERROR,
+                args=(self.kind, self.sources.get(regex, regex), e))
+            return Replacement_Template.literal(
+                replace if isinstance(replace, tuple) else (replace,))
+        if _template.groups > groups:
+            log("The replacement for {} rule {} uses {} groups, but it only "
+                "captures {}", LOGLEVEL.ERROR, args=(self.kind,
+                self.sources.get(regex, regex), _template.groups, groups))
+            return Replacement_Template.literal(
+                replace if isinstance(replace, tuple) else (replace,))
+        if _template.used < groups:
+            log("The replacement for {} rule {} only uses {} of the {} "
+                "groups it captures", LOGLEVEL.WARN, args=(self.kind,
+                self.sources.get(regex, regex), _template.used, groups))
+        return _template
+
+    def reset_buckets(self):
+        for _bucket in self.__buckets.values():
+            if _bucket is not None:
+                _bucket.fold(self.__totals)
+        self.__buckets = {}
+
+    @staticmethod
+    def literal_head(regex):
+        """Return the literal first character `regex` matches, if it has one.
+        """
+        if not regex:
+            return None
+        if regex[0] == '\\':
+            if len(regex) > 1 and not regex[1].isalnum():
+                return regex[1]
+            return None
+        if regex[0] in '.()[]{}*+?^$|':
+            return None
+        return regex[0]
+
+    @staticmethod
+    def literal_ends(regex):
+        """Return the literal text every match of `regex` starts and ends
+        with, and whether the whole of it is literal."""
+        _tokens = []
+        _escaped = False
+        for c in regex:
+            if _escaped:
+                _tokens.append(None if c.isalnum() else c)
+                _escaped = False
+            elif c == '\\':
+                _escaped = True
+            elif c in '.()[]{}*+?^$|':
+                _tokens.append(None)
+            else:
+                _tokens.append(c)
+        if None not in _tokens:
+            _text = ''.join(_tokens)
+            return _text, _text, True
+        _first = _tokens.index(None)
+        _last = len(_tokens)-_tokens[::-1].index(None)
+        return ''.join(_tokens[:_first]), ''.join(_tokens[_last:]), False
+
+    def disjoint(self, a, b):
+        """Return True if the rules with literal ends `a` and `b` can never
+        match the same line."""
+        if not (a[0].startswith(b[0]) or b[0].startswith(a[0])):
+            return True
+        if self.suffix == '$':
+            if a[2] and b[2]:
+                return a[0] != b[0]
+            return not (a[1].endswith(b[1]) or b[1].endswith(a[1]))
+        return False
+
+    def order(self, rules, heat):
+        """Return `rules` with the hottest first, wherever that can't change
+        which rule a line matches first. `heat` maps rules to how often they
+        were hit before.
+
+        A rule only ever moves in front of rules it is disjoint with, so the
+        first defined rule to match a line is still the first one tried.
+        """
+        if len(rules) < 2 or not any(heat.get(r) for r in rules):
+            return rules
+        _ends = [self.literal_ends(r) for r in rules]
+        _by_prefix = {}
+        for i, e in enumerate(_ends):
+            _by_prefix.setdefault(e[0], []).append(i)
+        _prefixes = sorted(_by_prefix)
+
+        # Rules with a prefix in common with rule i, defined before it
+        _before = [0]*len(rules)
+        _after = [[] for _ in rules]
+        for i, e in enumerate(_ends):
+            _others = set()
+            for n in range(len(e[0])+1):
+                _others.update(_by_prefix.get(e[0][:n], ()))
+            _start = bisect.bisect_left(_prefixes, e[0])
+            for p in _prefixes[_start:]:
+                if not p.startswith(e[0]):
+                    break
+                _others.update(_by_prefix[p])
+            for j in _others:
+                if j < i and not self.disjoint(_ends[j], e):
+                    _before[i] += 1
+                    _after[j].append(i)
+
+        _ready = [(-heat.get(r, 0), i) for i, r in enumerate(rules)
+                  if not _before[i]]
+        heapq.heapify(_ready)
+        _order = []
+        while _ready:
+            _, i = heapq.heappop(_ready)
+            _order.append(rules[i])
+            for j in _after[i]:
+                _before[j] -= 1
+                if not _before[j]:
+                    heapq.heappush(_ready, (-heat.get(rules[j], 0), j))
+        return _order
+
+    def compile(self, head):
+        log("Compiling combined regex for rules starting with '{}'",
+            LOGLEVEL.VERB, args=(head,))
+        _t = state["trace"]
+        if _t:
+            _t.begin("compile {} rules".format(self.kind), "rules",
+                     {"head": head})
+        _rules = [regex for regex, (_, _, _head) in self.rules.items()
+                  if _head is None or _head == head]
+        if config["adaptive_rule_order"]:
+            _rules = self.order(_rules, rule_heat()[self.kind])
+
+        _chunks = []
+        _alt = []
+        _index = {}
+        _group = 0
+        for i, regex in enumerate(_rules):
+            replace, groups, _ = self.rules[regex]
+            if _alt and _group+groups+1 > _max_groups:
+                _chunks.append((cached_regex('^(?:'+'|'.join(_alt)+')'),
+                                _index))
+                _alt = []
+                _index = {}
+                _group = 0
+            _alt.append(regex+self.suffix+'()')
+            _group += groups+1
+            _index[_group] = (tuple(range(_group-groups, _group)), replace, i)
+        if _alt:
+            _chunks.append((cached_regex('^(?:'+'|'.join(_alt)+')'), _index))
+
+        if _chunks:
+            _bucket = Rule_Bucket(_chunks, _rules)
+        else:
+            _bucket = None
+        self.__buckets[head] = _bucket
+        if _t:
+            _t.end({"rules": len(_rules)})
+        return _bucket
+
+    def match(self, line):
+        """Return `(replace, groups)` for the first matching rule or None."""
+        _head = line[:1]
+        try:
+            _bucket = self.__buckets[_head]
+        except KeyError:
+            _bucket = self.compile(_head)
+        if _bucket is None:
+            return None
+
+        if state["profile"]:
+            _start = _clock()
+        for regex, _index in _bucket.chunks:
+            _m = regex.match(line)
+            if _m is not None:
+                break
+        _time = _clock()-_start if state["profile"] else 0.0
+        if _m is None:
+            _bucket.misses += 1
+            _bucket.miss_time += _time
+            return None
+        groups, replace, i = _index[_m.lastindex]
+        _bucket.hits[i] += 1
+        _bucket.hit_time[i] += _time
+        return replace, tuple([_m.group(g) for g in groups])
+
+    def rule_stats(self):
+        """Return `[hits, attempts, seconds]` for every rule, in order."""
+        _totals = dict((k, list(v)) for k, v in self.__totals.items())
+        for _bucket in self.__buckets.values():
+            if _bucket is not None:
+                _bucket.fold(_totals)
+        return OrderedDict((regex, _totals.get(regex, [0, 0, 0.0]))
+                           for regex in self.definitions)
+
+    def rule_list(self):
+        """Return `[regex, replace, source]` for every rule, in order."""
+        return [[regex, replace, self.sources.get(regex)]
+                for regex, replace in self.definitions.items()]
+
+    def add_stats(self, rule_stats):
+        """Add `[hits, attempts, seconds]` counted for rules elsewhere, like
+        in a replayed import, to their stats."""
+        for regex, counts in rule_stats.items():
+            _t = self.__totals.setdefault(regex, [0, 0, 0.0])
+            for i, v in enumerate(counts):
+                _t[i] += v
+
+
+class Character_Rule_Set(Rule_Set):
+    """Character replacement rules, with literal names found by hash lookup.
+
+    Most character rules are a plain speaker name, so those are kept in a
+    dict and looked up with the first whitespace separated token of the
+    line. Rules containing wildcards fall back to the combined regex of
+    `Rule_Set`. A literal rule only wins if no wildcard rule defined before
+    it also matches the line.
+    """
+
+    kind = "character"
+    speaker_re = re.compile('(\S+)\s(.*)')
+
+    def __init__(self):
+        Rule_Set.__init__(self, '\s(.*)')
+        self.literals = {}
+        self.literal_hits = {}
+        self.order_of = {}
+        self.first_wildcard = None
+
+    def index(self, regex, replace):
+        _order = self.order_of.setdefault(regex, len(self.order_of))
+        _name = self.literal_text(regex)
+        if _name is not None:
+            self.literals[_name] = (
+                _order, Rule_Set.template(self, regex, replace, 1), regex)
+            return
+        Rule_Set.index(self, regex, replace)
+        if self.first_wildcard is None:
+            self.first_wildcard = _order
+
+    def template(self, regex, replace, groups):
+        return (self.order_of[regex],
+                Rule_Set.template(self, regex, replace, groups))
+
+    @staticmethod
+    def literal_text(regex):
+        """Return the text `regex` matches if it is a plain word, else None.
+        """
+        _text = []
+        _escaped = False
+        for c in regex:
+            if _escaped:
+                if c.isalnum():
+                    return None
+                _text.append(c)
+                _escaped = False
+            elif c == '\\':
+                _escaped = True
+            elif c in '.()[]{}*+?^$|' or c.isspace():
+                return None
+            else:
+                _text.append(c)
+        if _escaped or not _text:
+            return None
+        return ''.join(_text)
+
+    def match(self, line):
+        """Return `(replace, groups)` for the first matching rule or None."""
+        _literal = None
+        if self.literals:
+            _m = self.speaker_re.match(line)
+            if _m:
+                _literal = self.literals.get(_m.group(1))
+                if _literal is not None:
+                    _groups = (_m.group(2),)
+                    if (self.first_wildcard is None
+                            or _literal[0] < self.first_wildcard):
+                        return self.literal_hit(_literal, _groups)
+
+        _m = Rule_Set.match(self, line)
+        if _m is None:
+            if _literal is not None:
+                return self.literal_hit(_literal, _groups)
+            return None
+        (_order, replace), groups = _m
+        if _literal is not None and _literal[0] < _order:
+            return self.literal_hit(_literal, _groups)
+        return replace, groups
+
+    def literal_hit(self, literal, groups):
+        self.literal_hits[literal[2]] = self.literal_hits.get(literal[2], 0)+1
+        return literal[1], groups
+
+    def rule_stats(self):
+        """Return `[hits, attempts, seconds]` for every rule, in order.
+
+        Literal rules are found by a single lookup, so they are only ever
+        attempted on the lines they match.
+        """
+        _stats = Rule_Set.rule_stats(self)
+        for _, _, regex in self.literals.values():
+            _hits = self.literal_hits.get(regex, 0)
+            _stats[regex] = [_hits, _hits, 0.0]
+        return _stats
+
+    def add_stats(self, rule_stats):
+        _literals = set(regex for _, _, regex in self.literals.values())
+        for regex, counts in rule_stats.items():
+            if regex in _literals:
+                self.literal_hits[regex] = (self.literal_hits.get(regex, 0)
+                                            + counts[0])
+        Rule_Set.add_stats(self, dict((r, c) for r, c in rule_stats.items()
+                                      if r not in _literals))
 
 
 def line_regex(match, replace):
-    log("Building line replacement regex: {} = {}".format(match,
-        replace), LOGLEVEL.DEBUG)
+    log("Building line replacement regex: {} = {}", LOGLEVEL.DEBUG,
+        args=(match, replace))
     _rep = regex_prep(match)
-    log("Regex result: {}".format(_rep), LOGLEVEL.DEBUG)
-    _m = re.compile('^'+_rep+'$')
-    state["known_line_rep"][_m] = replace
+    log("Regex result: {}", LOGLEVEL.DEBUG, args=(_rep,))
+    state["known_line_rep"].add(_rep, replace, match)
+    record_definition("line", _rep, replace, match)
 
 
 def character_regex(match, replace):
-    log("Building character replacement regex: {} = {}".format(match,
-        replace), LOGLEVEL.DEBUG)
+    log("Building character replacement regex: {} = {}", LOGLEVEL.DEBUG,
+        args=(match, replace))
     _rep = regex_prep(match)
-    log("Regex result: {}".format(_rep), LOGLEVEL.DEBUG)
-    _m = re.compile('^'+_rep+'\s(.*)')
-    state["known_character_rep"][_m] = (replace, ' "{}"')
+    log("Regex result: {}", LOGLEVEL.DEBUG, args=(_rep,))
+    state["known_character_rep"].add(_rep, (replace, ' "{}"'), match)
+    record_definition("character", _rep, (replace, ' "{}"'), match)
+
+
+def rule_heat():
+    """Return how often each rule was hit in previous builds, by kind.
+
+    Kept in a file in the output directory, for `adaptive_rule_order`.
+    """
+    if state["rule_heat"] is None:
+        state["rule_heat"] = {"line": {}, "character": {}}
+        try:
+            with codecs.open(rule_heat_path(), 'r', "utf-8") as f:
+                _heat = json.load(f)
+            if _heat["version"] == 1:
+                state["rule_heat"] = _heat["rules"]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            log("No usable rule statistics at {}", LOGLEVEL.DEBUG,
+                args=(rule_heat_path(),))
+    return state["rule_heat"]
+
+
+def rule_heat_path():
+    return path.abspath(path.join(config["output_path"], '.rpsb-rules.json'))
+
+
+def save_rule_heat():
+    """Add the hits of this build to the rule heat and save it.
+
+    Older builds count for half as much each time, so the order follows
+    the script as it changes.
+    """
+    _heat = rule_heat()
+    for rule_set in (state["known_line_rep"], state["known_character_rep"]):
+        _old = _heat.get(rule_set.kind, {})
+        _new = {}
+        for regex, (hits, _, _) in rule_set.rule_stats().items():
+            _score = _old.get(regex, 0)/2.0+hits
+            if _score >= 0.5:
+                _new[regex] = _score
+        _heat[rule_set.kind] = _new
+
+    head, tail = path.split(rule_heat_path())
+    try:
+        _fd, _tmp = tempfile.mkstemp(prefix=tail, suffix='.tmp', dir=head)
+        with os.fdopen(_fd, 'wb') as f:
+            f.write(json.dumps({"version": 1, "rules": _heat}).encode('utf-8'))
+        replace_file(_tmp, rule_heat_path())
+    except (IOError, OSError):
+        log("Unable to save rule statistics at {}", LOGLEVEL.WARN,
+            args=(rule_heat_path(),))
+
+
+def rule_report(rule_set, name, top=5):
+    """Return lines for the build statistics about the rules in `rule_set`.
+    """
+    _stats = rule_set.rule_stats()
+    if not _stats:
+        return []
+    _never = [r for r, (hits, _, _) in _stats.items() if not hits]
+    _log = ["{} rules: {} defined, {} hit, {} never hit".format(
+        name, len(_stats), len(_stats)-len(_never), len(_never))]
+    _timed = state["profile"] is not None
+    for regex, (hits, attempts, seconds) in sorted(
+            _stats.items(), key=lambda i: -i[1][0])[:top]:
+        if not hits:
+            break
+        _log.append("    {:>8} hits {:>9} attempts{} : {}".format(
+            hits, attempts, " {:>8.3f}s".format(seconds) if _timed else '',
+            rule_set.sources.get(regex, regex)))
+    if _never:
+        _names = [rule_set.sources.get(r, r) for r in _never]
+        _log.append("    never hit: "+', '.join(_names[:10])+(
+            " and {} more".format(len(_names)-10) if len(_names) > 10
+            else ''))
+        log("Rules never hit: {}", LOGLEVEL.DEBUG, args=(', '.join(_names),))
+    return _log
 
 ##-----------------------------------------------------------------------------
 ## File manager
 ##-----------------------------------------------------------------------------
 
+class Source_File(object):
+    """An input file, read in bulk rather than a line at a time.
+
+    Normal sized files are read and decoded whole and split into lines in
+    one go. Larger ones are memory mapped and decoded a chunk at a time, so
+    the text of a dump hundreds of MB in size is never held all at once. A
+    UTF-8 byte order mark is dropped. Lines keep their line endings and are
+    split as by `str.splitlines`, like the codecs reader did.
+    """
+
+    mmap_size = 64*1024*1024
+    chunk_size = 4*1024*1024
+
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+        self.__file = open(name, 'rb')
+
+    def __iter__(self):
+        if os.fstat(self.__file.fileno()).st_size < self.mmap_size:
+            return iter(self.read().splitlines(True))
+        return self.__mapped_lines()
+
+    def read(self):
+        return self.__file.read().decode('utf-8-sig')
+
+    def __mapped_lines(self):
+        _map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        _decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        _partial = ''
+        try:
+            for _start in range(0, len(_map), self.chunk_size):
+                _lines = (_partial+_decoder.decode(
+                    _map[_start:_start+self.chunk_size])).splitlines(True)
+                # The last line may go on in the next chunk, even if it
+                # seems to end here with a \r
+                _partial = _lines.pop() if _lines else ''
+                for line in _lines:
+                    yield line
+            for line in (_partial+_decoder.decode(b'', True)).splitlines(
+                    True):
+                yield line
+        finally:
+            _map.close()
+
+    def close(self):
+        self.closed = True
+        self.__file.close()
+
+
+def read_source(file_path):
+    """Return the text of the input file at `file_path`."""
+    _file = Source_File(file_path)
+    try:
+        return _file.read()
+    finally:
+        _file.close()
+
+
+class Output_File(object):
+    """An output file that is only written to disk once it is closed.
+
+    Output is collected in a spooled temporary file, which stays in memory
+    for normal sized files and rolls over to disk for very large ones. On
+    close, the content hash is compared to the file already on disk and the
+    file is only replaced, through a temp file and rename, if it changed.
+    That way Ren'Py never sees a half written file and unchanged files
+    keep their timestamps. The output of an aborted build is discarded
+    instead, leaving the file on disk as it was.
+
+    A file can be suspended to free its buffer, which moves the output so
+    far to that temp file. It is reopened in append mode on the next write.
+    """
+
+    chunk_size = 64*1024
+    spool_size = 8*1024*1024
+
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+        self.size = 0
+        self.__chunks = []
+        self.__pending = 0
+        self.__hash = hashlib.sha1()
+        self.__buffer = tempfile.SpooledTemporaryFile(self.spool_size)
+        self.__part = None
+
+    def write(self, data):
+        self.__chunks.append(data)
+        self.__pending += len(data)
+        if self.__pending >= self.chunk_size:
+            self.__flush_chunks()
+
+    def __flush_chunks(self):
+        if not self.__chunks:
+            return
+        _data = ''.join(self.__chunks).encode('utf-8')
+        self.__chunks = []
+        self.__pending = 0
+        if self.__buffer is None:
+            self.__buffer = open(self.__part, 'ab')
+        self.__hash.update(_data)
+        self.__buffer.write(_data)
+        self.size += len(_data)
+
+    def hexdigest(self):
+        self.__flush_chunks()
+        return self.__hash.hexdigest()
+
+    def __save(self):
+        """Copy the output so far to a new temp file beside the file and
+        return its path."""
+        head, tail = path.split(self.name)
+        _fd, _tmp = tempfile.mkstemp(prefix='.'+tail, suffix='.tmp', dir=head)
+        try:
+            with os.fdopen(_fd, 'wb') as f:
+                self.__buffer.seek(0)
+                for chunk in iter(lambda: self.__buffer.read(1024*1024),
+                                  b''):
+                    f.write(chunk)
+        except:
+            os.remove(_tmp)
+            raise
+        return _tmp
+
+    def suspend(self):
+        """Move the output so far to disk and release the buffer."""
+        if self.closed or self.__buffer is None:
+            return
+        self.__flush_chunks()
+        if self.__part is None:
+            try:
+                self.__part = self.__save()
+            except (IOError, OSError):
+                log("Unable to suspend {}; keeping it open", LOGLEVEL.DEBUG,
+                    args=(self.name,))
+                return
+        self.__buffer.close()
+        self.__buffer = None
+
+    def close(self):
+        """Write the output to disk if it differs from what is there.
+
+        Returns True if the file was written.
+        """
+        if self.closed:
+            return False
+        self.closed = True
+        _path_for_log = self.name.replace(os.getcwd(), '.')
+
+        _digest = self.hexdigest()
+        if self.__buffer is not None and self.__part is not None:
+            self.__buffer.close()
+            self.__buffer = None
+        if file_hash(self.name, self.size) == _digest:
+            log("{} is unchanged; skipping write", LOGLEVEL.DEBUG,
+                args=(_path_for_log,))
+            stats["unchanged_files"] += 1
+            if self.__part is not None:
+                os.remove(self.__part)
+            else:
+                self.__buffer.close()
+            return False
+
+        log("Writing {}", LOGLEVEL.DEBUG, args=(_path_for_log,))
+        try:
+            _tmp = self.__part or self.__save()
+            try:
+                try:
+                    _mode = os.stat(self.name).st_mode & 0o7777
+                except OSError:
+                    _mode = 0o666 & ~_umask()
+                os.chmod(_tmp, _mode)
+                replace_file(_tmp, self.name)
+            except:
+                os.remove(_tmp)
+                raise
+        except (IOError, OSError):
+            log("Unable to write the file at {}", LOGLEVEL.ERROR,
+                exit=False, args=(_path_for_log,))
+            return False
+        finally:
+            if self.__buffer is not None:
+                self.__buffer.close()
+        return True
+
+    def discard(self):
+        """Drop the output, leaving the file on disk as it was."""
+        if self.closed:
+            return
+        self.closed = True
+        self.__chunks = []
+        if self.__buffer is not None:
+            self.__buffer.close()
+            self.__buffer = None
+        if self.__part is not None:
+            try:
+                os.remove(self.__part)
+            except OSError:
+                pass
+
+
+class File_Registry(object):
+    """The output files of a build, keyed by absolute path.
+
+    Output files are also kept in the order they were last written to. Once
+    more than `max_open_files` of them hold a buffer, the least recently
+    written is suspended until it is written to again, so builds producing
+    many files don't run out of file descriptors or memory. An unbounded
+    registry never suspends files, for builds that don't close them.
+    """
+
+    def __init__(self, bounded=True):
+        self.files = {}
+        self.active = OrderedDict()
+        self.bounded = bounded
+
+    def __iter__(self):
+        return iter(list(self.files.values()))
+
+    def __len__(self):
+        return len(self.files)
+
+    def get(self, name):
+        return self.files.get(name)
+
+    def add(self, file):
+        self.files[file.name] = file
+
+    def touch(self, file):
+        """Mark `file` as the most recently written."""
+        if not self.bounded or not isinstance(file, Output_File):
+            return
+        _active = self.active
+        _active.pop(file.name, None)
+        _active[file.name] = file
+        while len(_active) > max(1, config["max_open_files"]):
+            _active.popitem(last=False)[1].suspend()
+
+
+class Stream_File(object):
+    """An output file that hands its lines to a `Builder` as they are
+    written, instead of writing them to disk.
+
+    Complete lines are appended to `sink` as `(out_file, line)` pairs, where
+    `out_file` is the file's path relative to the output directory.
+    """
+
+    def __init__(self, name, sink):
+        self.name = name
+        self.closed = False
+        self.out_name = path.relpath(name, path.abspath(config["output_path"]))
+        self.__sink = sink
+        self.__partial = ''
+
+    def write(self, data):
+        _lines = (self.__partial+data).split('\n')
+        self.__partial = _lines.pop()
+        for line in _lines:
+            self.__sink.append((self.out_name, line))
+
+    def close(self):
+        if self.closed:
+            return False
+        self.closed = True
+        if self.__partial:
+            self.__sink.append((self.out_name, self.__partial))
+            self.__partial = ''
+        return False
+
+    def discard(self):
+        self.closed = True
+        self.__partial = ''
+
+
+class Check_File(object):
+    """An output file that is only hashed, for checking that the file on
+    disk is up to date.
+
+    On close, the hash is compared to the file on disk, and the file's path
+    is added to `stale` if they differ. Nothing is ever written.
+    """
+
+    def __init__(self, name, stale):
+        self.name = name
+        self.closed = False
+        self.size = 0
+        self.__hash = hashlib.sha1()
+        self.__stale = stale
+
+    def write(self, data):
+        _data = data.encode('utf-8')
+        self.__hash.update(_data)
+        self.size += len(_data)
+
+    def close(self):
+        if self.closed:
+            return False
+        self.closed = True
+        if file_hash(self.name, self.size) == self.__hash.hexdigest():
+            stats["unchanged_files"] += 1
+        else:
+            self.__stale.append(self.name)
+        return False
+
+    def discard(self):
+        self.closed = True
+
+
+def _umask():
+    _mask = os.umask(0)
+    os.umask(_mask)
+    return _mask
+
+
 def loop_file(in_file):
+    _p = state["profile"]
+    if _p:
+        _prev = _p.switch("input")
     file = open_file(in_file, "r")
+    _t = state["trace"]
+    if _t:
+        _t.begin(trace_name(in_file), "file", {"chain": [
+            trace_name(_f["file_path"]) for _f in state["file_chain"]]})
+    if _p:
+        _prev_file = _p.set_file(in_file)
     log("Parsing file {}".format(in_file), LOGLEVEL.DEBUG)
+    state["input_stamps"][in_file] = file_stamp(in_file)
+    for _r in state["recorders"]:
+        _r.deps[in_file] = input_hash(in_file)
     state['cur_in_file'] = file
     if stats["in_files"] == 1:
         state["master_in_file"] = file
 
-    for _lineno, line in enumerate(file, start=1):
-        state["file_chain"][-1]["cur_line"] = _lineno
-        parse_line(line)
+    try:
+        for _lineno, line in enumerate(file, start=1):
+            state["file_chain"][-1]["cur_line"] = _lineno
+            if _p:
+                _p.switch("parse")
+            parse_line(line)
+            if _p:
+                _p.switch("input")
+    finally:
+        file.close()
 
+    flush_ir()
     state["file_chain"].pop()
+    if _t:
+        _t.end()
+    if _p:
+        _p.set_file(_prev_file)
+        _p.switch(_prev)
 
 
 def open_file(file_path, mode='w'):
@@ -549,6 +1983,7 @@ def open_file(file_path, mode='w'):
             if tail == file_path:
                 file_path = path.join(config["output_path"], file_path)
 
+    if mode == 'w' and state["stream"] is None and state["check"] is None:
         head, tail = path.split(file_path)
         try:
             os.makedirs(head)
@@ -557,51 +1992,75 @@ def open_file(file_path, mode='w'):
             pass
 
     _path = path.abspath(path.expanduser(path.expandvars(file_path)))
-    for f in state["open_files"]:
-        if _path == f.name:
-            return f
+    if mode != 'r':
+        # A file read again, like a header imported by several files, needs
+        # a handle of its own
+        _file = state["open_files"].get(_path)
+        if _file is not None:
+            return _file
 
     _path_for_log = _path.replace(os.getcwd(), '.')
     _mode = {'r': 'READ', 'w': 'WRITE', 'a': 'APPEND'}
     log("Opening new file {} in {} mode".format(_path_for_log, _mode[mode]),
         LOGLEVEL.INFO)
-    try:
-        file = codecs.open(_path, mode, "utf-8")
-    except IOError:
-        log("Unable to open the file at {}".format(_path_for_log),
-            LOGLEVEL.ERROR)
-
-    state["open_files"].add(file)
+    _t = state["trace"] if mode != 'r' else None
+    if _t:
+        _t.begin("open "+_path_for_log, "output", {"mode": _mode[mode]})
+    if mode == 'r':
+        try:
+            file = Source_File(_path)
+        except (IOError, OSError):
+            log("Unable to open the file at {}".format(_path_for_log),
+                LOGLEVEL.ERROR)
+    elif state["stream"] is not None:
+        file = Stream_File(_path, state["stream"])
+    else:
+        if state["check"] is not None:
+            file = Check_File(_path, state["check"])
+        else:
+            file = Output_File(_path)
+        if mode == 'a' and path.isfile(_path):
+            with codecs.open(_path, 'r', "utf-8") as f:
+                state["ir"].append('raw', f.read(), -1, file, _path, 0)
 
     if mode == 'r':
         stats["in_files"] += 1
-        dir_name, file_name = path.split(_path)
-        if state["next_out_file"] is None:
-            root, _ = path.splitext(file_name)
-            next_out_file(root+'.rpy')
-        state["file_chain"].append({
-                "file": file,
-                "file_path": _path,
-                "file_dir": dir_name,
-                "file_name": file_name,
-                "cur_line": 0,
-                "cur_indent": 0,
-                "prev_indent": 0,
-                "new_indent": False,
-                "prev_whitespace": [],
-                # "temp_dedent": [],
-                "command_block": False,
-                "command": (None, None),
-                "blank_line": True,
-                "label_chain": [],
-                "next_label_call": None
-            })
+        push_file_chain(file, _path)
     else:
+        state["open_files"].add(file)
         stats["out_files"] += 1
+    if _t:
+        _t.end()
 
     return file
 
 
+def push_file_chain(file, file_path):
+    """Start parsing `file`, read from `file_path`."""
+    dir_name, file_name = path.split(file_path)
+    if state["next_out_file"] is None:
+        root, _ = path.splitext(file_name)
+        next_out_file(root+'.rpy')
+    state["file_chain"].append({
+        "file": file,
+        "file_path": file_path,
+        "key": import_key(file_path),
+        "file_dir": dir_name,
+        "file_name": file_name,
+        "cur_line": 0,
+        "cur_indent": 0,
+        "prev_indent": 0,
+        "new_indent": False,
+        "indents": Indent_Stack(-1 if nvl_mode() else None),
+        # "temp_dedent": [],
+        "command_block": False,
+        "command": (None, None),
+        "blank_line": True,
+        "label_chain": [],
+        "next_label_call": None
+    })
+
+
 def get_out_file():
     if not state["cur_out_file"]:
         state["cur_out_file"] = open_file(state["next_out_file"])
@@ -615,7 +2074,8 @@ def next_out_file(file):
     state["cur_out_file"] = None
 
 
-def write_line(line=None, indent=True, file=None):
+def write_line(line=None, indent=True, file=None, kind='blank'):
+    """Add a line of output, a node of `kind`, to the build's IR."""
     _f = state["file_chain"][-1]
     if line is None:
         if not _f["blank_line"]:
@@ -626,334 +2086,1525 @@ def write_line(line=None, indent=True, file=None):
     else:
         _f["blank_line"] = False
 
-    log("Writing line to output", LOGLEVEL.VERB)
+    if log.enabled_for(LOGLEVEL.VERB):
+        log("Writing line to output", LOGLEVEL.VERB)
     file = file or get_out_file()
 
     if line != '' and line[-1] != '"':
         line = line.replace('\\n', '\n')
-
-    if indent:
-        _i = str(_il)
-        file.write('\n'.join([_i+l.strip() for l in line.split('\n')])+'\n')
-    else:
-        file.write(line+'\n')
+    _ir = state["ir"]
+    _level = _f["indents"].level() if indent else -1
+    _ir.append(kind, line, _level, file, _f["file_path"], _f["cur_line"])
+    if len(_ir.text) >= _ir.flush_size:
+        flush_ir()
 
     if config["create_flow_control_file"]:
-        _label = _f["next_label_call"]
-        if _label:
-            log("Adding label call to control file", LOGLEVEL.DEBUG)
-            _f["next_label_call"] = None
+        write_label_call(_f)
+
+    stats["out_lines"] += line.count('\n')+1
+
+
+def write_label_call(_f):
+    _label = _f["next_label_call"]
+    if _label:
+        log("Adding label call to control file", LOGLEVEL.DEBUG)
+        _f["next_label_call"] = None
+        if not state["control_file"]:
+            state["control_file"] = open_file("control.rpy", 'w')
+            write_line("label _control:", False, state["control_file"],
+                       kind='control')
+        write_line("    call "+full_label_name(_f, _label), False,
+                   state["control_file"], kind='control')
+    _f["next_label_call"] = None
+
+##-----------------------------------------------------------------------------
+## Intermediate representation
+##-----------------------------------------------------------------------------
+
+# The kinds of statement a node can be. 'raw' nodes are written exactly as
+# they are, without a line ending.
+NODE_KINDS = ('raw', 'blank', 'comment', 'python', 'label', 'narration',
+              'dialogue', 'replacement', 'scene', 'show', 'with', 'play',
+              'voice', 'queue', 'stop', 'call', 'jump', 'return', 'menu',
+              'condition', 'nvl_clear', 'control')
+_node_kind = dict((k, i) for i, k in enumerate(NODE_KINDS))
+
+
+class Script_IR(object):
+    """Compiled statements, between parsing and writing them out.
+
+    Each node is one statement: its kind, the output file it goes to, its
+    indent level (-1 if it isn't indented), the input file and line it came
+    from and its text, which `emit_ir` renders into Ren'Py source with the
+    indent. Nodes are stored a column per field in
+    arrays, with all of the source in one UTF-8 buffer, so a node costs 15
+    bytes plus its text and a run of nodes for the same file is written out
+    in one go. `to_json` and `from_json` let an IR be kept between builds;
+    the columns and text are stored compressed.
+    """
+
+    columns = ('kinds', 'indents', 'targets', 'sources', 'lines', 'ends',
+               'starts')
+    flush_size = 64*1024
+
+    def __init__(self):
+        self.kinds = array('B')
+        self.indents = array('h')
+        self.targets = array('I')
+        self.sources = array('I')
+        self.lines = array('I')
+        self.ends = array('I')
+        # The first node of each run of nodes going to the same file
+        self.starts = array('I')
+        self.text = bytearray()
+        self.target_names = []
+        self.source_names = []
+        self.files = []
+        self.__target_index = {}
+        self.__source_index = {}
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __iter__(self):
+        """Yield `(kind, indent, target, source, line, text)` per node,
+        where `target` and `source` index `files`/`target_names` and
+        `source_names`."""
+        _text = self.text
+        _start = 0
+        for i, _end in enumerate(self.ends):
+            yield (NODE_KINDS[self.kinds[i]], self.indents[i],
+                   self.targets[i], self.sources[i], self.lines[i],
+                   _text[_start:_end].decode('utf-8'))
+            _start = _end
+
+    def target(self, file):
+        """Return the index of the output `file`, adding it if need be."""
+        _t = self.__target_index.get(file.name)
+        if _t is None:
+            _t = self.__target_index[file.name] = len(self.target_names)
+            self.target_names.append(file.name)
+            self.files.append(file)
+        return _t
+
+    def source(self, file_path):
+        _s = self.__source_index.get(file_path)
+        if _s is None:
+            _s = self.__source_index[file_path] = len(self.source_names)
+            self.source_names.append(file_path)
+        return _s
+
+    def append(self, kind, text, indent, file, source, line):
+        _t = self.__target_index.get(file.name)
+        if _t is None:
+            _t = self.target(file)
+        _s = self.__source_index.get(source)
+        if _s is None:
+            _s = self.source(source)
+        if not self.targets or self.targets[-1] != _t:
+            self.starts.append(len(self.targets))
+        self.kinds.append(_node_kind[kind])
+        self.indents.append(indent)
+        self.targets.append(_t)
+        self.sources.append(_s)
+        self.lines.append(line)
+        self.text += text.encode('utf-8')
+        self.ends.append(len(self.text))
+
+    def extend(self, ir, start, stop, file):
+        """Append nodes `start` to `stop` of `ir`, all going to `file`."""
+        _count = stop-start
+        _t = self.target(file)
+        _sources = [self.source(n) for n in ir.source_names]
+        _offset = len(self.text)-(ir.ends[start-1] if start else 0)
+        if not self.targets or self.targets[-1] != _t:
+            self.starts.append(len(self.targets))
+
+        self.kinds.extend(ir.kinds[start:stop])
+        self.indents.extend(ir.indents[start:stop])
+        self.targets.extend(array('I', [_t])*_count)
+        self.sources.extend(array('I', [_sources[s] for s in
+                                        ir.sources[start:stop]]))
+        self.lines.extend(ir.lines[start:stop])
+        self.ends.extend(array('I', [e+_offset for e in
+                                     ir.ends[start:stop]]))
+        self.text += ir.text[ir.ends[start-1] if start else 0:
+                             ir.ends[stop-1]]
+
+    def runs(self):
+        """Yield `(start, stop, target)` for each run of nodes going to the
+        same output file."""
+        _starts = self.starts
+        for i, _start in enumerate(_starts):
+            _stop = _starts[i+1] if i+1 < len(_starts) else len(self.targets)
+            yield _start, _stop, self.targets[_start]
+
+    def to_json(self):
+        _columns = {}
+        for name in self.columns:
+            _a = getattr(self, name)
+            if sys.byteorder == 'big':
+                _a = array(_a.typecode, _a)
+                _a.byteswap()
+            # array.tostring and fromstring are the Python 2 names
+            _columns[name] = _pack(_a.tobytes() if hasattr(_a, 'tobytes')
+                                   else _a.tostring())
+        return {
+            "targets": self.target_names,
+            "sources": self.source_names,
+            "columns": _columns,
+            "text": _pack(bytes(self.text)),
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        """Rebuild an IR saved with `to_json`. Its `files` are all None."""
+        ir = cls()
+        for name in cls.columns:
+            _a = getattr(ir, name)
+            _data = _unpack(data["columns"][name])
+            if hasattr(_a, 'frombytes'):
+                _a.frombytes(_data)
+            else:
+                _a.fromstring(_data)
+            if sys.byteorder == 'big':
+                _a.byteswap()
+        ir.text = bytearray(_unpack(data["text"]))
+        ir.target_names = list(data["targets"])
+        ir.source_names = list(data["sources"])
+        ir.files = [None]*len(ir.target_names)
+        ir.__target_index = dict((n, i) for i, n in
+                                 enumerate(ir.target_names))
+        ir.__source_index = dict((n, i) for i, n in
+                                 enumerate(ir.source_names))
+        return ir
+
+
+def _pack(data):
+    return base64.b64encode(zlib.compress(data, 1)).decode('ascii')
+
+
+def _unpack(data):
+    return zlib.decompress(base64.b64decode(data))
+
+
+def render_node(kind, indent, text):
+    """Return the Ren'Py source for a statement."""
+    if kind == 'raw':
+        return text
+    if indent < 0:
+        return text+'\n'
+    _i = indent_prefix(indent)
+    if '\n' in text:
+        return '\n'.join([_i+l.strip() for l in text.split('\n')])+'\n'
+    return _i+text.strip()+'\n'
+
+
+def emit_ir(ir, files=None):
+    """Write the nodes of `ir` to their output files.
+
+    `files` are the open output files, in the order of `ir.target_names`;
+    by default those the IR was built with. Imports being recorded for the
+    build manifest get a copy of every node.
+    """
+    _p = state["profile"]
+    if _p:
+        _prev = _p.switch("write")
+    _t = state["trace"]
+    if _t:
+        _t.begin("write statements", "output", {"nodes": len(ir)})
+    files = files or ir.files
+    _touch = state["open_files"].touch
+    _text = ir.text
+    _ends = ir.ends
+    _kinds = ir.kinds
+    _indents = ir.indents
+    for start, stop, target in ir.runs():
+        _start = _ends[start-1] if start else 0
+        _out = []
+        for i in range(start, stop):
+            _end = _ends[i]
+            _out.append(render_node(NODE_KINDS[_kinds[i]], _indents[i],
+                                    _text[_start:_end].decode('utf-8')))
+            _start = _end
+        _touch(files[target])
+        files[target].write(''.join(_out))
+        for _r in state["recorders"]:
+            _r.record(ir, start, stop, files[target])
+    if _t:
+        _t.end()
+    if _p:
+        _p.switch(_prev)
+
+
+def flush_ir():
+    """Write out the statements compiled so far."""
+    _ir = state["ir"]
+    if _ir:
+        state["ir"] = Script_IR()
+        emit_ir(_ir)
+
+##-----------------------------------------------------------------------------
+## Build manifest
+##-----------------------------------------------------------------------------
+
+class Build_Manifest(object):
+    """Record of every imported file compiled by the previous build.
+
+    For each import we keep the hash of the file and of everything it
+    imported in turn, a hash of the rules, config and output state it was
+    compiled under and everything it did: the output it wrote, the rules
+    and config it left behind and its stats. A later build importing the
+    same unchanged files under the same conditions replays that instead of
+    parsing them again. The manifest is stored next to the output.
+    """
+
+    version = 8
+    file_name = '.rpsb-manifest.json'
+    max_entries = 4
+
+    def __init__(self, output_path):
+        self.path = path.abspath(path.join(output_path, self.file_name))
+        self.old = {}
+        self.new = OrderedDict()
+        try:
+            with codecs.open(self.path, 'r', "utf-8") as f:
+                _manifest = json.load(f)
+            if (_manifest["version"] == self.version
+                    and _manifest["builder"] == __version__):
+                self.old = _manifest["imports"]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            log("No usable build manifest at {}", LOGLEVEL.DEBUG,
+                args=(self.path,))
+
+    def find(self, file_path, context):
+        """Return the entry for `file_path` built under `context`, if all of
+        the files it depends on are unchanged."""
+        for _entries in (self.new.get(file_path, ()),
+                         self.old.get(file_path, ())):
+            for entry in _entries:
+                if entry["context"] != context:
+                    continue
+                if all(input_hash(p) == h
+                       for p, h in entry["deps"].items()):
+                    self.add(file_path, entry)
+                    return entry
+        return None
+
+    def add(self, file_path, entry):
+        _entries = [e for e in self.new.get(file_path, ())
+                    if e["context"] != entry["context"]]
+        self.new[file_path] = ([entry]+_entries)[:self.max_entries]
+
+    def save(self):
+        log("Saving build manifest", LOGLEVEL.DEBUG)
+        head, tail = path.split(self.path)
+        _data = json.dumps({
+            "version": self.version,
+            "builder": __version__,
+            "imports": self.new
+        })
+        try:
+            _fd, _tmp = tempfile.mkstemp(prefix=tail, suffix='.tmp', dir=head)
+            with os.fdopen(_fd, 'wb') as f:
+                f.write(_data.encode('utf-8'))
+            replace_file(_tmp, self.path)
+        except (IOError, OSError):
+            log("Unable to save the build manifest at {}", LOGLEVEL.WARN,
+                args=(self.path,))
+
+
+class Prelude_Cache(object):
+    """Rules and config defined by imported files that do nothing else.
+
+    Projects often import the same header of rule and config definitions at
+    the top of every chapter. Such an import is recorded once, as the rule
+    patterns, templates and config values it defines, keyed by the hash of
+    its content. Later imports of it, in this build or later ones, restore
+    those definitions instead of parsing the file, as long as nothing it
+    imports in turn has changed. The cache is stored next to the output and
+    loaded once per build.
+    """
+
+    version = 2
+    file_name = '.rpsb-preludes.json'
+
+    def __init__(self, output_path):
+        self.path = path.abspath(path.join(output_path, self.file_name))
+        self.old = {}
+        self.new = {}
+        try:
+            with codecs.open(self.path, 'r', "utf-8") as f:
+                _cache = json.load(f)
+            if (_cache["version"] == self.version
+                    and _cache["builder"] == __version__):
+                self.old = _cache["preludes"]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            log("No usable prelude cache at {}", LOGLEVEL.DEBUG,
+                args=(self.path,))
+
+    def find(self, file_path):
+        """Return the snapshot for `file_path`, if it and every file it
+        imports are unchanged."""
+        _hash = input_hash(file_path)
+        snapshot = self.new.get(_hash) or self.old.get(_hash)
+        if snapshot is None:
+            return None
+        if all(input_hash(p) == h for p, h in snapshot["deps"].items()):
+            self.new[_hash] = snapshot
+            return snapshot
+        return None
+
+    def add(self, file_path, snapshot):
+        self.new[input_hash(file_path)] = snapshot
+
+    def save(self):
+        """Save the snapshots that are still valid, if they changed."""
+        _preludes = dict((k, snapshot) for k, snapshot in self.old.items()
+                         if all(input_hash(p) == h
+                                for p, h in snapshot["deps"].items()))
+        _preludes.update(self.new)
+        if _preludes == self.old:
+            return
+        log("Saving prelude cache", LOGLEVEL.DEBUG)
+        head, tail = path.split(self.path)
+        _data = json.dumps({
+            "version": self.version,
+            "builder": __version__,
+            "preludes": _preludes
+        })
+        try:
+            _fd, _tmp = tempfile.mkstemp(prefix=tail, suffix='.tmp', dir=head)
+            with os.fdopen(_fd, 'wb') as f:
+                f.write(_data.encode('utf-8'))
+            replace_file(_tmp, self.path)
+        except (IOError, OSError):
+            log("Unable to save the prelude cache at {}", LOGLEVEL.WARN,
+                args=(self.path,))
+        self.old, self.new = _preludes, {}
+
+
+class Import_Recorder(object):
+    """Collects everything an imported file does, for the build manifest and
+    the prelude cache.
+
+    The output is only kept if there is a build `context` to store it
+    under.
+    """
+
+    def __init__(self, file_path, context):
+        self.file_path = file_path
+        self.context = context
+        self.deps = {}
+        self.ir = Script_IR()
+        self.wrote = False
+        self.replayed = False
+        self.definitions = []
+        self.imports = []
+        self.labels = []
+        self.stats = dict(stats)
+        self.counts = log.counts()
+        self.outputs = self.__outputs()
+        self.line_rules = OrderedDict(state["known_line_rep"].definitions)
+        self.character_rules = OrderedDict(
+            state["known_character_rep"].definitions)
+        self.rule_stats = (state["known_line_rep"].rule_stats(),
+                           state["known_character_rep"].rule_stats())
+
+    @staticmethod
+    def __outputs():
+        _cur = state["cur_out_file"]
+        _control = state["control_file"]
+        return (state["next_out_file"],
+                _cur.name if _cur else None,
+                _control.name if _control else None,
+                sorted(state["parent_labels"]))
+
+    def record(self, ir, start, stop, file):
+        self.wrote = True
+        if self.context is not None:
+            self.ir.extend(ir, start, stop, file)
+
+    def rule_stats_delta(self):
+        """Return the hits, attempts and time of the rules used by the
+        import, by kind."""
+        _delta = {}
+        for before, rule_set in zip(self.rule_stats, (
+                state["known_line_rep"], state["known_character_rep"])):
+            _counts = {}
+            for regex, now in rule_set.rule_stats().items():
+                _then = before.get(regex, (0, 0, 0.0))
+                if now[0] != _then[0] or now[1] != _then[1]:
+                    _counts[regex] = [n-t for n, t in zip(now, _then)]
+            _delta[rule_set.kind] = _counts
+        return _delta
+
+    def stats_delta(self):
+        return dict((k, stats[k]-self.stats[k]) for k in stats
+                    if k not in ("start_time", "out_files"))
+
+    def prelude(self):
+        """Return the prelude snapshot of the import, or None if it did
+        more than define rules and config."""
+        if (self.wrote or self.replayed or log.counts() != self.counts
+                or self.__outputs() != self.outputs):
+            return None
+        _snapshot = {
+            "deps": self.deps,
+            "definitions": self.definitions,
+            "imports": self.imports,
+            "stats": self.stats_delta(),
+        }
+        try:
+            json.dumps(_snapshot)
+        except (TypeError, ValueError):
+            return None
+        return _snapshot
+
+    def entry(self):
+        """Return the manifest entry for the import, or None if it shouldn't
+        be reused."""
+        if log.counts() != self.counts:
+            # Warnings and errors need to be reported on every build
+            return None
+
+        def _delta(before, rule_set):
+            return [[k, v, rule_set.sources.get(k)]
+                    for k, v in rule_set.definitions.items()
+                    if k not in before or before[k] != v]
+
+        _cur = state["cur_out_file"]
+        _control = state["control_file"]
+        _entry = {
+            "context": self.context,
+            "deps": self.deps,
+            "ir": self.ir.to_json(),
+            "exit": {
+                "line_rules": _delta(self.line_rules,
+                                     state["known_line_rep"]),
+                "character_rules": _delta(self.character_rules,
+                                          state["known_character_rep"]),
+                "config": config_snapshot(),
+                "next_out_file": state["next_out_file"],
+                "cur_out_file": _cur.name if _cur else None,
+                "control_file": _control.name if _control else None,
+                "parent_labels": sorted(state["parent_labels"]),
+                "imports": self.imports,
+                "labels": self.labels,
+            },
+            "stats": self.stats_delta(),
+            "rule_stats": self.rule_stats_delta(),
+        }
+        try:
+            json.dumps(_entry)
+        except (TypeError, ValueError):
+            log("Build of {} can't be stored in the manifest", LOGLEVEL.DEBUG,
+                args=(self.file_path,))
+            return None
+        return _entry
+
+
+def config_snapshot():
+    _config = dict(config)
+    _config["flow_control_ignore"] = [r.pattern for r in
+                                      config["flow_control_ignore"]]
+    return _config
+
+
+def build_context():
+    """Return a hash of everything that affects how an import compiles."""
+    _cur = state["cur_out_file"]
+    _control = state["control_file"]
+    _context = [
+        __version__,
+        os.getcwd(),
+        state["known_line_rep"].digest(),
+        state["known_character_rep"].digest(),
+        config_snapshot(),
+        nvl_mode(),
+        state["next_out_file"],
+        _cur.name if _cur else None,
+        _control.name if _control else None,
+        sorted(state["parent_labels"]),
+        imported_keys(),
+    ]
+    return hashlib.sha1(json.dumps(_context, sort_keys=True,
+        default=repr).encode('utf-8')).hexdigest()
+
+
+def restore_config(snapshot):
+    for k, v in snapshot.items():
+        if k == "flow_control_ignore":
+            v = [re.compile(p) for p in v]
+        config[k] = v
+
+
+def replay_import(entry, current_output=None, control_file=None):
+    """Redo everything a recorded import did to the build.
+
+    Output recorded against `current_output` goes to whatever the current
+    output file is, and that against `control_file` goes to the control
+    file, opening it first if need be.
+    """
+    _stats = dict(stats)
+    ir = Script_IR.from_json(entry["ir"])
+    _files = []
+    for name in ir.target_names:
+        if name == current_output:
+            _files.append(get_out_file())
+        elif name == control_file:
             if not state["control_file"]:
                 state["control_file"] = open_file("control.rpy", 'w')
-                write_line("label _control:", False, state["control_file"])
-            if _label[0] == '.':
-                write_line("    call "+_f["label_chain"][-1]+_label,
-                           False, state["control_file"])
-            else:
-                write_line("    call "+_label, False, state["control_file"])
-        _f["next_label_call"] = None
+                _header = Script_IR()
+                _header.append('control', "label _control:", -1,
+                               state["control_file"], ir.source_names[0], 0)
+                emit_ir(_header)
+                _stats["out_lines"] += 1
+            _files.append(state["control_file"])
+        else:
+            _files.append(open_file(name))
+    emit_ir(ir, _files)
+
+    _exit = entry["exit"]
+    for regex, replace, source in _exit["line_rules"]:
+        state["known_line_rep"].add(regex, replace, source)
+    for regex, replace, source in _exit["character_rules"]:
+        state["known_character_rep"].add(regex, tuple(replace), source)
+    restore_config(_exit["config"])
+
+    if _exit["next_out_file"] != PARALLEL_OUTPUT:
+        state["next_out_file"] = _exit["next_out_file"]
+        state["cur_out_file"] = None
+        if _exit["cur_out_file"]:
+            state["cur_out_file"] = open_file(_exit["cur_out_file"])
+    if _exit["control_file"] and _exit["control_file"] != control_file:
+        state["control_file"] = open_file(_exit["control_file"])
+    state["parent_labels"] = set(_exit["parent_labels"])
+    for key, skipped in _exit["imports"]:
+        record_import(key, skipped)
+    for kind, name, source, line in _exit["labels"]:
+        state["labels"].add(kind, name, source, line)
+
+    for k, v in entry["stats"].items():
+        stats[k] = _stats[k]+v
+    state["known_line_rep"].add_stats(entry["rule_stats"]["line"])
+    state["known_character_rep"].add_stats(entry["rule_stats"]["character"])
+    for _r in state["recorders"]:
+        _r.deps.update(entry["deps"])
+        _r.replayed = True
+
+
+def record_definition(kind, key, value, source=None):
+    """Note a "line" or "character" rule or "config" setting defined by the
+    imports being recorded."""
+    for _r in state["recorders"]:
+        _r.definitions.append([kind, key, value, source])
+
+
+def record_import(key, skipped=False):
+    """Note a file imported, or skipped as already imported, by the build
+    and the imports being recorded."""
+    if not skipped:
+        state["imported"].add(key)
+    for _r in state["recorders"]:
+        _r.imports.append([key, skipped])
+
+
+def imports_match(imports):
+    """Return whether the recorded nested `imports` of a file would each be
+    skipped, or not, the same way if it was imported now."""
+    _imported = set(state["imported"])
+    for key, skipped in imports:
+        if skipped != (config["import_once"] and key in _imported):
+            return False
+        _imported.add(key)
+    return True
+
+
+def restore_prelude(snapshot):
+    """Redo the definitions of a prelude snapshot."""
+    for kind, key, value, source in snapshot["definitions"]:
+        if kind == "line":
+            state["known_line_rep"].add(key, value, source)
+        elif kind == "character":
+            value = tuple(value)
+            state["known_character_rep"].add(key, value, source)
+        elif key == "flow_control_ignore":
+            config[key] = [re.compile(p) for p in value]
+        else:
+            config[key] = value
+        record_definition(kind, key, value, source)
+    for key, skipped in snapshot["imports"]:
+        record_import(key, skipped)
+
+    for k, v in snapshot["stats"].items():
+        stats[k] += v
+    for _r in state["recorders"]:
+        _r.deps.update(snapshot["deps"])
+
+
+def import_key(file_path):
+    """Return the key identifying a file however its path is written."""
+    return path.normcase(path.realpath(file_path))
+
+
+def imported_keys():
+    """Return the files imported so far, if that affects later imports."""
+    if config["import_once"]:
+        return sorted(state["imported"])
+    return None
+
+
+def import_file(file_path):
+    """Parse an imported file, or restore it from the prelude cache, the
+    build manifest or a parallel build."""
+    flush_ir()
+    _preludes = config["prelude_cache"] and state["stream"] is None
+    if _preludes:
+        if state["preludes"] is None:
+            state["preludes"] = Prelude_Cache(config["output_path"])
+        snapshot = state["preludes"].find(file_path)
+        if snapshot is not None and imports_match(snapshot["imports"]):
+            log("{} is unchanged; restoring its rules and config",
+                LOGLEVEL.INFO, args=(file_path.replace(os.getcwd(), '.'),))
+            restore_prelude(snapshot)
+            if state["trace"]:
+                state["trace"].note(source="prelude cache")
+            return
+
+    _context = None
+    if ((config["incremental_build"] or state["watch"])
+            and state["stream"] is None):
+        if state["manifest"] is None:
+            state["manifest"] = Build_Manifest(config["output_path"])
+        _context = build_context()
+        entry = state["manifest"].find(file_path, _context)
+        if entry is not None:
+            log("{} is unchanged; reusing previous build", LOGLEVEL.INFO,
+                args=(file_path.replace(os.getcwd(), '.'),))
+            replay_import(entry)
+            if state["trace"]:
+                state["trace"].note(source="build manifest")
+            return
+
+    _recorder = None
+    if _context is not None or _preludes:
+        _recorder = Import_Recorder(file_path, _context)
+        state["recorders"].append(_recorder)
+
+    try:
+        if not merge_parallel_build(file_path):
+            loop_file(file_path)
+    finally:
+        if _recorder:
+            state["recorders"].remove(_recorder)
+
+    if _context is not None:
+        entry = _recorder.entry()
+        if entry is not None:
+            state["manifest"].add(file_path, entry)
+    if _preludes:
+        snapshot = _recorder.prelude()
+        if snapshot is not None:
+            log("Caching the rules and config of {}", LOGLEVEL.DEBUG,
+                args=(file_path,))
+            state["preludes"].add(file_path, snapshot)
+
+##-----------------------------------------------------------------------------
+## Parallel build
+##-----------------------------------------------------------------------------
+
+# Stands in for whatever the output file is at the point of the import
+PARALLEL_OUTPUT = '<parallel output>'
+
+
+def parallel_key():
+    """Return a hash of the state an import is compiled under, apart from
+    the output files, which a parallel build resolves when merging."""
+    _key = [
+        state["known_line_rep"].digest(),
+        state["known_character_rep"].digest(),
+        config_snapshot(),
+        nvl_mode(),
+        sorted(state["parent_labels"]),
+        imported_keys(),
+    ]
+    return hashlib.sha1(json.dumps(_key, sort_keys=True,
+        default=repr).encode('utf-8')).hexdigest()
+
+
+prescan_command_re = re.compile("^([ \t]*)(:[^\r\n]*)", re.M)
+prescan_line_re = re.compile("([ \t]*)([^\r\n]*)\r?\n?")
+
+
+def _prescan_file(file_path, tasks, top=False, chain=()):
+    """Apply only the rule, config and parent label definitions of a file.
+
+    Only lines starting with a command (and the blocks those open) are
+    looked at. The top level imports of the master file are added to
+    `tasks` along with the definitions in effect where they are imported.
+    """
+    text = read_source(file_path)
+    chain += (import_key(file_path),)
+
+    _skip_to = 0
+    for _m in prescan_command_re.finditer(text):
+        if _m.start() < _skip_to:
+            continue
+        _indent = len(_m.group(1))
+        line = _m.group(2).strip().replace('"', r'\"')
+        keyword = command_key_re.match(line).group(1)
+
+        if keyword in ('line', 'character', 'config'):
+            parse_command(keyword, line)
+
+        elif keyword in ('line:', 'character:', 'config:'):
+            keyword = keyword[:-1]
+            _pos = _m.end()+1
+            while _pos < len(text):
+                _l = prescan_line_re.match(text, _pos)
+                if _l.group(2).strip() and not comment_re.match(_l.group(0)):
+                    if len(_l.group(1)) <= _indent:
+                        break
+                    parse_command(keyword, ':'+keyword+' '+
+                        _l.group(2).strip().replace('"', r'\"'))
+                _pos = _l.end()
+            _skip_to = _pos
+
+        elif keyword == ':' and config["create_parent_files"]:
+            _label = command_table[':'][0].match(line)
+            _parent = parent_label_re.match(_label.group(2).strip())
+            if _parent and _parent.group(1):
+                state["parent_labels"].add(_parent.group(1))
+
+        elif keyword == 'import':
+            _import = command_table['import'][0].match(line)
+            if not _import:
+                continue
+            _path = path.abspath(path.expanduser(path.expandvars(
+                _import.group(2).strip())))
+            _key = import_key(_path)
+            if _key in chain or (config["import_once"]
+                                 and _key in state["imported"]):
+                continue
+            state["imported"].add(_key)
+            if top and _indent == 0:
+                tasks.append({
+                    "file_path": _path,
+                    "cwd": os.getcwd(),
+                    "debug": _debug,
+                    "check": state["check"] is not None,
+                    "line_rules": state["known_line_rep"].rule_list(),
+                    "character_rules":
+                        state["known_character_rep"].rule_list(),
+                    "config": config_snapshot(),
+                    "parent_labels": sorted(state["parent_labels"]),
+                    "imported": sorted(state["imported"]),
+                })
+            _prescan_file(_path, tasks, chain=chain)
+
+
+def plan_parallel_build(in_file, jobs):
+    """First pass of a parallel build.
+
+    Quickly runs through the master file and everything it imports, applying
+    only the rule and config definitions, to find the state each top level
+    import will be compiled under. Those imports are then compiled on a
+    process pool while the master file is parsed as normal, and merged in
+    order as their `:import` is reached. A result is only used if the state
+    really matches at that point; otherwise the file is compiled as usual,
+    so the output is always the same as a serial build.
+    """
+    global log
+    try:
+        from concurrent.futures import ProcessPoolExecutor
+    except ImportError:
+        log("Parallel builds need the concurrent.futures module; "
+            "building serially", LOGLEVEL.WARN)
+        return
+
+    log("Planning parallel build", LOGLEVEL.DEBUG)
+    _t = state["trace"]
+    if _t:
+        _t.begin("plan parallel build", "build")
+    _log, _config, _stats = log, dict(config), dict(stats)
+    log = _Logger([], quiet=True)
+    tasks = []
+    try:
+        _prescan_file(in_file, tasks, top=True)
+        if log.counts() != (0, 0):
+            tasks = []
+    except (Exception, SystemExit):
+        tasks = []
+    finally:
+        log = _log
+        config.clear()
+        config.update(_config)
+        stats.update(_stats)
+        state["known_line_rep"] = Rule_Set('$')
+        state["known_character_rep"] = Character_Rule_Set()
+        state["parent_labels"] = set()
+        state["imported"] = set()
+    if _t:
+        _t.end({"imports": len(tasks)})
+
+    if not tasks:
+        log("Nothing to build in parallel", LOGLEVEL.DEBUG)
+        return
+
+    log("Building {} imported files on {} processes", LOGLEVEL.INFO,
+        args=(len(tasks), jobs))
+    state["pool"] = ProcessPoolExecutor(jobs)
+    for task in tasks:
+        state["parallel_builds"].setdefault(task["file_path"], []).append(
+            state["pool"].submit(_parallel_build_worker, task))
+
+
+def _parallel_build_worker(task):
+    """Compile one imported file in a worker process.
+
+    Nothing is written to disk; everything the import does is recorded and
+    returned for the main process to merge.
+    """
+    global log, _debug
+    _debug = task["debug"]
+    log = _Logger([], quiet=True)
+    os.chdir(task["cwd"])
+
+    reset_build()
+    state.update({
+        "next_out_file": PARALLEL_OUTPUT,
+        "open_files": File_Registry(bounded=False),
+        "trace": None,
+        # Nothing a worker opens is ever closed, but in a check no output
+        # directories may be made either
+        "check": [] if task["check"] else None,
+        "parent_labels": set(task["parent_labels"]),
+        "imported": set(task["imported"]),
+        "manifest": None,
+        "file_hashes": {},
+    })
+    for regex, replace, source in task["line_rules"]:
+        state["known_line_rep"].add(regex, replace, source)
+    for regex, replace, source in task["character_rules"]:
+        state["known_character_rep"].add(regex, replace, source)
+    restore_config(task["config"])
+    _current = open_file(PARALLEL_OUTPUT)
+    _control = open_file("control.rpy", 'w')
+    state["control_file"] = _control
+
+    _key = parallel_key()
+    _recorder = Import_Recorder(task["file_path"], _key)
+    state["recorders"].append(_recorder)
+    try:
+        loop_file(task["file_path"])
+    except (Exception, SystemExit):
+        return None
+    entry = _recorder.entry()
+    if entry is None:
+        return None
+    return {
+        "key": _key,
+        "entry": entry,
+        "prelude": _recorder.prelude(),
+        "current_output": _current.name,
+        "control_file": _control.name,
+    }
+
+
+def merge_parallel_build(file_path):
+    """Merge the parallel build of `file_path` into the build, if there is
+    one and it was compiled under the current state."""
+    _builds = state["parallel_builds"].get(file_path)
+    if not _builds:
+        return False
+    _result = _builds.pop(0).result()
+    if _result is None or _result["key"] != parallel_key():
+        log("Parallel build of {} can't be used; building it serially",
+            LOGLEVEL.DEBUG, args=(file_path,))
+        return False
+
+    log("Merging parallel build of {}", LOGLEVEL.DEBUG, args=(file_path,))
+    if state["trace"]:
+        state["trace"].note(source="parallel build")
+    replay_import(_result["entry"], _result["current_output"],
+                  _result["control_file"])
+    if _result["prelude"] is not None and state["preludes"] is not None:
+        state["preludes"].add(file_path, _result["prelude"])
+    return True
+
+##-----------------------------------------------------------------------------
+## Batch build
+##-----------------------------------------------------------------------------
+
+def expand_inputs(patterns):
+    """Return the source files named by `patterns`, which may be globs, in
+    order and without repeats."""
+    _files = []
+    for _pattern in patterns:
+        _pattern = path.expanduser(path.expandvars(_pattern))
+        if glob.has_magic(_pattern):
+            _matches = sorted(glob.glob(_pattern))
+            if not _matches:
+                log("{} matches no files".format(_pattern), LOGLEVEL.WARN)
+        else:
+            _matches = [_pattern]
+        for _file in _matches:
+            _file = path.abspath(_file)
+            if _file not in _files:
+                _files.append(_file)
+    return _files
+
+
+def _batch_build_worker(task):
+    """Build one entry script of a batch build, as `main` would.
+
+    Nothing is printed. The log is saved next to the script, named after
+    it, and the warnings, errors and stats of the build are returned.
+    """
+    global log, _debug
+    _debug = task["debug"]
+    in_file = task["file_path"]
+    _name, _ = path.splitext(path.basename(in_file))
+    if not path.isfile(in_file):
+        return {"file_path": in_file, "stats": {}, "problems": [
+            (LOGLEVEL.ERROR, "{} is not an accessible file".format(in_file))]}
+
+    os.chdir(path.dirname(in_file))
+    _file, _ = path.splitext(path.basename(__file__))
+    log = _Logger([], file_path="{}.{}.log".format(_file, _name),
+                  save=not task["check"])
+    reset_build(dict(_config_defaults,
+                     flow_control_ignore=default_flow_control_ignore()))
+    state.update({
+        "manifest": None,
+        "preludes": None,
+        "rule_heat": None,
+        "file_hashes": {},
+        "input_stamps": {},
+        "check": [] if task["check"] else None,
+    })
+    # Output directories are made when the first file is written to them
+    if task["output_path"]:
+        config["output_path"] = path.join(path.expandvars(path.expanduser(
+            task["output_path"])), _name)
+    else:
+        config["output_path"] = '.'
+
+    _stdout, _devnull = sys.stdout, open(os.devnull, 'w')
+    sys.stdout = _devnull
+    try:
+        try:
+            try:
+                build_file(in_file)
+            except Exception:
+                log.log_traceback()
+        except SystemExit:
+            pass
+        finally:
+            finish_build()
+    finally:
+        _problems = list(log.problems)
+        log.close()
+        sys.stdout = _stdout
+        _devnull.close()
+
+    return {
+        "file_path": in_file,
+        "stats": dict((k, v) for k, v in stats.items() if k != "start_time"),
+        "problems": _problems,
+    }
+
+
+def batch_build(in_files, output_path, jobs, check=False):
+    """Build several entry scripts, each on its own, on `jobs` processes.
+
+    Each script is built as if it was the only one, with its output going
+    to a directory named after it within `output_path`, if one is given.
+    The warnings and errors of every build are logged together at the end,
+    and the stats added up.
+    """
+    global log
+    tasks = [{"file_path": f, "output_path": output_path, "debug": _debug,
+              "check": check} for f in in_files]
+    jobs = min(jobs, len(tasks))
+    _pool = None
+    try:
+        from concurrent.futures import ProcessPoolExecutor
+        _pool = ProcessPoolExecutor(jobs)
+    except ImportError:
+        pass
+
+    if _pool is not None:
+        with _pool:
+            results = list(_pool.map(_batch_build_worker, tasks))
+    else:
+        # Build here, one after another, putting back what the builds change
+        _log, _cwd = log, os.getcwd()
+        _config, _stats = dict(config), dict(stats)
+        results = []
+        for task in tasks:
+            try:
+                results.append(_batch_build_worker(task))
+            finally:
+                log = _log
+                os.chdir(_cwd)
+        config.clear()
+        config.update(_config)
+        stats.update(_stats)
+        state.update({"manifest": None, "preludes": None, "check": None})
+
+    setup_globals(save_log=not check)
+    # The rules are those of each build, so there are none to report here
+    state["known_line_rep"] = None
+    state["known_character_rep"] = None
+    for result in results:
+        _name = trace_name(result["file_path"])
+        for level, msg in result["problems"]:
+            log("[{}] {}", level, exit=False, args=(_name, msg))
+        for k, v in result["stats"].items():
+            stats[k] += v
+        _errors = sum(1 for level, _ in result["problems"]
+                      if level >= LOGLEVEL.ERROR)
+        log("{} {}", LOGLEVEL.INFO, args=(_name, "failed" if _errors
+            else "checked" if check else "built"))
+    log("Built {} source files on {} processes", LOGLEVEL.INFO,
+        args=(len(results), jobs if _pool is not None else 1))
+
+##-----------------------------------------------------------------------------
+## Label table
+##-----------------------------------------------------------------------------
+
+label_target_re = re.compile(r"\s*(\.?[A-Za-z_][\w.]*)")
+
+
+class Label_Table(object):
+    """Every label the build writes and every jump and call to a label.
 
-    stats["out_lines"] += len(line.split('\n'))
+    Labels are kept by their full dotted name, in a dict, along with where
+    they were defined. Jumps and calls are checked against it once the
+    build is done, so a label can be used before it is defined.
+    """
+
+    def __init__(self):
+        self.labels = {}
+        self.duplicates = []
+        self.references = []
+
+    def add(self, kind, name, source, line):
+        """Note a "label" defined, or a "jump" or "call" to the label
+        `name`, at `line` of the file `source`."""
+        for _r in state["recorders"]:
+            _r.labels.append([kind, name, source, line])
+        if kind != "label":
+            self.references.append((kind, name, source, line))
+        elif name in self.labels:
+            self.duplicates.append((name, source, line, self.labels[name]))
+        else:
+            self.labels[name] = (source, line)
+
+    def check(self):
+        """Log every label defined more than once and every jump or call to
+        a label that isn't defined."""
+        for name, source, line, first in self.duplicates:
+            log("Label {} is already defined at {}", LOGLEVEL.ERROR,
+                exit=False, args=(name, line_location(*first)),
+                where=line_location(source, line))
+        _labels = self.labels
+        for kind, name, source, line in self.references:
+            if name not in _labels:
+                log("{} to undefined label {}", LOGLEVEL.WARN,
+                    args=(kind.capitalize(), name),
+                    where=line_location(source, line))
+
+
+def full_label_name(_f, name):
+    """Return the full name of label `name` in the file being parsed."""
+    if name[0] == '.' and _f["label_chain"]:
+        return _f["label_chain"][-1]+name
+    return name
+
+
+def add_label(kind, name):
+    """Note a label defined, or a jump or call to one, on the current line.
+    Jumps and calls to an expression are left out."""
+    _f = state["file_chain"][-1]
+    if kind != "label":
+        _m = label_target_re.match(name)
+        if not _m or _m.group(1) in ("expression", "screen"):
+            return
+        name = _m.group(1)
+    else:
+        name = name.split('(')[0].strip()
+    state["labels"].add(kind, full_label_name(_f, name), _f["file_path"],
+                        _f["cur_line"])
 
 ##-----------------------------------------------------------------------------
 ## Commands
 ##-----------------------------------------------------------------------------
 
+def command(keyword, pattern):
+    """Register the decorated function as the handler for `keyword`.
+
+    `keyword` is the text between the leading `:` and the first space, as
+    extracted by `command_key_re`, and `pattern` is the regex the full
+    (quote escaped) line must match for the handler to be called.
+    """
+    def _register(func):
+        command_table[keyword] = (re.compile(pattern), func)
+        return func
+    return _register
+
+
 def parse_command_block(line):
-    log("Parsing next line in command block", LOGLEVEL.VERB)
+    if log.enabled_for(LOGLEVEL.VERB):
+        log("Parsing next line in command block", LOGLEVEL.VERB)
     _f = state['file_chain'][-1]
     _c = _f["command"]
 
-    _m = _c[1].match(':'+_c[0]+' '+line)
+    if not parse_command(_c, ':'+_c+' '+line):
+        log("Unable to parse line in {} block".format(_c), LOGLEVEL.ERROR)
+
+
+def parse_command(keyword, line):
+    """Dispatch `line` to the handler registered for `keyword`.
+
+    Returns False if there is no such command or the line doesn't match its
+    pattern, so the caller can carry on treating the line as something else.
+    """
+    _entry = command_table.get(keyword)
+    if _entry is None:
+        return False
+    _p = state["profile"]
+    if _p:
+        _prev = _p.switch("commands")
+    _re, _handler = _entry
+    _m = _re.match(line)
+    if not _m:
+        if _p:
+            _p.switch(_prev)
+        return False
+
+    command = _m.group(1)
+    matches = [m.strip() for m in _m.groups()[1:] if m is not None]
+    log("Parsing command '{}' {}", LOGLEVEL.DEBUG, args=(command, matches))
+    stats["commands_processed"] += 1
+    _handler(matches)
+    if _p:
+        _p.switch(_prev)
+    return True
 
-    parse_command(_m.group(1), _m.groups()[0:], _c[1])
 
+def _write_play(channel, sound):
+    write_line("play "+channel+' '+ \
+        sound.replace(r'\"', '"').replace(r"\'", "'"), kind='play')
 
-def parse_command(command, matches, _re):
-    matches = [m.strip() for m in matches[1:]]
-    log("Parsing command '{}' {}".format(command, matches), LOGLEVEL.DEBUG)
-    stats["commands_processed"] += 1
+
+def _open_command_block(command):
+    log("New indent is now expected", LOGLEVEL.VERB)
     _f = state['file_chain'][-1]
+    _f["new_indent"] = 1
+    _f["command_block"] = True
+    _f["command"] = command
 
-    def _write_play(channel, sound):
-        write_line("play "+channel+' '+ \
-            sound.replace(r'\"', '"').replace(r"\'", "'"))
 
-    # ^:(line)\s*(.*?)=\s?(.*)$
-    if command == "line":
-        log("command: New line replacement", LOGLEVEL.DEBUG)
-        line_regex(matches[0], matches[1])
+@command("line", "^:(line)\s+(.*?)\s*=\s*(.*)$")
+def _cmd_line(matches):
+    log("command: New line replacement", LOGLEVEL.DEBUG)
+    line_regex(matches[0], matches[1])
 
-    # ^:(line:)$
-    elif command == "line:":
-        log("command: Line replacement block", LOGLEVEL.DEBUG)
-        log("New indent is now expected", LOGLEVEL.VERB)
-        _f["new_indent"] = 1
-        _f["command_block"] = True
-        _f["command"] = ('line', _re)
-
-    # ^:(character)\s*(.*?)=\s?(.*)$
-    if command == "character":
-        log("command: New character replacement", LOGLEVEL.DEBUG)
-        character_regex(matches[0], matches[1])
-
-    # ^:(character:)$
-    elif command == "character:":
-        log("command: Character replacement block", LOGLEVEL.DEBUG)
-        log("New indent is now expected", LOGLEVEL.VERB)
-        _f["new_indent"] = 1
-        _f["command_block"] = True
-        _f["command"] = ('character', _re)
-
-    # ^:(:)\s+(\.?[\w\.]*)$
-    # TODO: Move all of this to another function and fix it up
-    # TODO: Integrate auto_return for labels with content.
-    elif command == ":":
-        log("command: Label", LOGLEVEL.DEBUG)
-        _m = parent_label_re.match(matches[0])
-        if _m and _m.groups()[0]:
-            log("Parent label: {}".format(_m.group(1)), LOGLEVEL.DEBUG)
-            # TODO: fix this so we write to the correct parent file if it is
-            #       already open
-            if config["create_parent_files"]:
-                if _m.group(1) not in state["parent_labels"]:
-                    log("New parent file: {}".format(_m.group(1)))
-                    next_out_file(_m.group(1)+'.rpy')
-                    state["parent_labels"].add(_m.group(1))
 
-        _f["next_label_call"] = None
+@command("line:", "^:(line:)$")
+def _cmd_line_block(matches):
+    log("command: Line replacement block", LOGLEVEL.DEBUG)
+    _open_command_block('line')
 
-        write_line('label '+matches[0]+':')
 
-        if config["create_flow_control_file"]:
-            ignore = False
-            for _re in config["flow_control_ignore"]:
-                if _re.match(matches[0]):
-                    ignore = True
-                    break
-            if not ignore:
-                _f["next_label_call"] = matches[0]
-
-        # Build label chain links
-        # TODO: Fix this mess up
-        if matches[0][0] != '.':
-            _parent = matches[0].split('.')[0]
-            if _parent not in _f["label_chain"]:
-                _f["label_chain"].append(_parent)
-                # log(_f["label_chain"])
-
-    # ^:(sc)\s*(\w*)$
-    elif command == "sc":
-        log("command: Scene", LOGLEVEL.DEBUG)
-        write_line('scene '+matches[0])
-
-    # ^:(s)\s*(\w*)$
-    elif command == "s":
-        log("command: Show", LOGLEVEL.DEBUG)
-        write_line('show '+matches[0])
-
-    # ^:(w)\s*(\w*)$
-    elif command == "w":
-        log("command: With", LOGLEVEL.DEBUG)
-        write_line('with '+matches[0])
-
-    # ^:(p)\s+(.*?)\s+(.*)$
-    elif command == "p":
-        log("command: Play", LOGLEVEL.DEBUG)
-        _write_play(matches[0], matches[1])
-
-    # ^:(pm)\s+(.*)$
-    elif command == "pm":
-        log("command: Play music", LOGLEVEL.DEBUG)
-        _write_play("music", matches[0])
-
-    # ^:(ps)\s+(.*)$
-    elif command == "ps":
-        log("command: Play sound", LOGLEVEL.DEBUG)
-        _write_play("sound", matches[0])
-
-    # ^:(pa)\s+(.*)$
-    elif command == "pa":
-        log("command: Play audio", LOGLEVEL.DEBUG)
-        _write_play("audio", matches[0])
-
-    # ^:(v)\s+(.*)$
-    elif command == "v":
-        log("command: Voice", LOGLEVEL.DEBUG)
-        write_line("voice "+matches[0].replace(r'\"', '"').replace(r"\'", "'"))
-
-    # ^:(q)\s+(.*?)\s+(.*)$
-    elif command == "q":
-        log("command: Queue", LOGLEVEL.DEBUG)
-        write_line("queue "+matches[0]+' '+ \
-            matches[1].replace(r'\"', '"').replace(r"\'", "'"))
-
-    # ^:(stop)\s*(.*)?$
-    elif command == "stop":
-        log("command: Stop", LOGLEVEL.DEBUG)
-        write_line("stop "+matches[0])
-
-    # ^:(c)\s*(\w*)$
-    elif command == "c":
-        log("command: Call", LOGLEVEL.DEBUG)
-        write_line('call '+matches[0])
-
-    # ^:(j)\s*(\w*)$
-    elif command == "j":
-        log("command: Jump", LOGLEVEL.DEBUG)
-        # TODO: Work propper label chain into this
-        write_line('jump '+matches[0])
-
-    # ^:(r)$
-    # ^:(r)\s+(.*)$
-    elif command == "r":
-        log("command: Return", LOGLEVEL.DEBUG)
-        if len(matches) >= 1:
-            write_line("return {}".format(matches[0]))
-        else:
-            write_line('return')
+@command("character", "^:(character)\s+(.*?)\s*=\s*(.*)$")
+def _cmd_character(matches):
+    log("command: New character replacement", LOGLEVEL.DEBUG)
+    character_regex(matches[0], matches[1])
 
-    # ^:(choice):$
-    elif command == "choice":
-        log("command: New menu block", LOGLEVEL.DEBUG)
-        log("New indent is now expected", LOGLEVEL.VERB)
-        _f["new_indent"] = 1
-        write_line('menu:')
 
-    # ^:(if)\s*(.*?):$
-    elif command == "if":
-        log("command: if statement", LOGLEVEL.DEBUG)
-        log("New indent is now expected", LOGLEVEL.VERB)
-        _f["new_indent"] = 1
-        write_line('if '+matches[0]+':')
+@command("character:", "^:(character:)$")
+def _cmd_character_block(matches):
+    log("command: Character replacement block", LOGLEVEL.DEBUG)
+    _open_command_block('character')
 
-    # ^:(elif)\s*(.*?):$
-    elif command == "elif":
-        log("command: elif statement", LOGLEVEL.DEBUG)
-        log("New indent is now expected", LOGLEVEL.VERB)
-        _f["new_indent"] = 1
-        write_line('elif '+matches[0]+':')
 
-    # ^:(else):$
-    elif command == "else":
-        log("command: else statement", LOGLEVEL.DEBUG)
-        log("New indent is now expected", LOGLEVEL.VERB)
-        _f["new_indent"] = 1
-        write_line('else:')
+# TODO: Integrate auto_return for labels with content.
+@command(":", "^:(:)\s*(\.?.*?):?$")
+def _cmd_label(matches):
+    log("command: Label", LOGLEVEL.DEBUG)
+    _f = state['file_chain'][-1]
+    _m = parent_label_re.match(matches[0])
+    if _m and _m.groups()[0]:
+        log("Parent label: {}".format(_m.group(1)), LOGLEVEL.DEBUG)
+        # TODO: fix this so we write to the correct parent file if it is
+        #       already open
+        if config["create_parent_files"]:
+            if _m.group(1) not in state["parent_labels"]:
+                log("New parent file: {}".format(_m.group(1)))
+                next_out_file(_m.group(1)+'.rpy')
+                state["parent_labels"].add(_m.group(1))
+
+    _f["next_label_call"] = None
+
+    write_line('label '+matches[0]+':', kind='label')
+    add_label("label", matches[0])
 
-    # ^:(nvl):$
-    elif command == "nvl":
-        log("command: New NVL block", LOGLEVEL.DEBUG)
-        log("New indent is now expected", LOGLEVEL.VERB)
-        _f["new_indent"] = 1
-        state["is_nvl_mode"] = True
+    if config["create_flow_control_file"]:
+        _ignore = flow_control_ignore_re()
+        if not (_ignore and _ignore.match(matches[0])):
+            _f["next_label_call"] = matches[0]
 
-    # ^:(clear)$
-    elif command == "clear":
-        log("command: NVL clear", LOGLEVEL.DEBUG)
-        if state["is_nvl_mode"]:
-            write_line("nvl clear")
-        else:
-            write_line()
-
-    # ^:(import)\s*(.*)$
-    elif command == "import":
-        log("command: Import new file for reading", LOGLEVEL.DEBUG)
-        _f = path.abspath(path.expanduser(path.expandvars(matches[0])))
-        if path.isfile(_f) is False:
-            log("{} is not an accessible file".format(
-                matches[0]), LOGLEVEL.ERROR)
-        log("Importing file {}".format(matches[0]), LOGLEVEL.INFO)
-        loop_file(_f)
-
-    # ^:(file)\s*(.*)$
-    elif command == "file":
-        log("command: New output file", LOGLEVEL.DEBUG)
-        next_out_file(matches[0])
-
-    # ^:(log)\s*(0|1|2|3|4|VERBOSE|DEBUG|INFO|WARN|WARNING|ERROR)\s*(.*)$
-    elif command == "log":
-        log("command: write to log", LOGLEVEL.VERB)
+    # Build label chain links
+    # TODO: Fix this mess up
+    if matches[0][0] != '.':
+        _parent = matches[0].split('.')[0]
+        if _parent not in _f["label_chain"]:
+            _f["label_chain"].append(_parent)
+
+
+@command("sc", "^:(sc)\s+(.*)$")
+def _cmd_scene(matches):
+    log("command: Scene", LOGLEVEL.DEBUG)
+    write_line('scene '+matches[0], kind='scene')
+
+
+@command("s", "^:(s)\s+(.*)$")
+def _cmd_show(matches):
+    log("command: Show", LOGLEVEL.DEBUG)
+    write_line('show '+matches[0], kind='show')
+
+
+@command("w", "^:(w)\s+(.*)$")
+def _cmd_with(matches):
+    log("command: With", LOGLEVEL.DEBUG)
+    write_line('with '+matches[0], kind='with')
+
+
+@command("p", "^:(p)\s+(.*?)\s+(.*)$")
+def _cmd_play(matches):
+    log("command: Play", LOGLEVEL.DEBUG)
+    _write_play(matches[0], matches[1])
+
+
+@command("pm", "^:(pm)\s+(.*)$")
+def _cmd_play_music(matches):
+    log("command: Play music", LOGLEVEL.DEBUG)
+    _write_play("music", matches[0])
+
+
+@command("ps", "^:(ps)\s+(.*)$")
+def _cmd_play_sound(matches):
+    log("command: Play sound", LOGLEVEL.DEBUG)
+    _write_play("sound", matches[0])
+
+
+@command("pa", "^:(pa)\s+(.*)$")
+def _cmd_play_audio(matches):
+    log("command: Play audio", LOGLEVEL.DEBUG)
+    _write_play("audio", matches[0])
+
+
+@command("v", "^:(v)\s+(.*)$")
+def _cmd_voice(matches):
+    log("command: Voice", LOGLEVEL.DEBUG)
+    write_line("voice "+matches[0].replace(r'\"', '"').replace(r"\'", "'"),
+               kind='voice')
+
+
+@command("q", "^:(q)\s+(.*?)\s+(.*)$")
+def _cmd_queue(matches):
+    log("command: Queue", LOGLEVEL.DEBUG)
+    write_line("queue "+matches[0]+' '+ \
+        matches[1].replace(r'\"', '"').replace(r"\'", "'"), kind='queue')
+
+
+@command("stop", "^:(stop)\s*(.*)?$")
+def _cmd_stop(matches):
+    log("command: Stop", LOGLEVEL.DEBUG)
+    write_line("stop "+matches[0], kind='stop')
+
+
+@command("c", "^:(c)\s+(.*)$")
+def _cmd_call(matches):
+    log("command: Call", LOGLEVEL.DEBUG)
+    write_line('call '+matches[0], kind='call')
+    add_label("call", matches[0])
+
+
+@command("j", "^:(j)\s+(.*)$")
+def _cmd_jump(matches):
+    log("command: Jump", LOGLEVEL.DEBUG)
+    write_line('jump '+matches[0], kind='jump')
+    add_label("jump", matches[0])
+
+
+@command("r", "^:(r)(?:\s+(.*))?$")
+def _cmd_return(matches):
+    log("command: Return", LOGLEVEL.DEBUG)
+    if len(matches) >= 1:
+        write_line("return {}".format(matches[0]), kind='return')
+    else:
+        write_line('return', kind='return')
+
+
+@command("choice:", "^:(choice):$")
+def _cmd_choice(matches):
+    log("command: New menu block", LOGLEVEL.DEBUG)
+    log("New indent is now expected", LOGLEVEL.VERB)
+    state['file_chain'][-1]["new_indent"] = 1
+    write_line('menu:', kind='menu')
+
+
+@command("if", "^:(if)\s+(.*?):$")
+def _cmd_if(matches):
+    log("command: if statement", LOGLEVEL.DEBUG)
+    log("New indent is now expected", LOGLEVEL.VERB)
+    state['file_chain'][-1]["new_indent"] = 1
+    write_line('if '+matches[0]+':', kind='condition')
+
+
+@command("elif", "^:(elif)\s+(.*?):$")
+def _cmd_elif(matches):
+    log("command: elif statement", LOGLEVEL.DEBUG)
+    log("New indent is now expected", LOGLEVEL.VERB)
+    state['file_chain'][-1]["new_indent"] = 1
+    write_line('elif '+matches[0]+':', kind='condition')
+
+
+@command("else:", "^:(else):$")
+def _cmd_else(matches):
+    log("command: else statement", LOGLEVEL.DEBUG)
+    log("New indent is now expected", LOGLEVEL.VERB)
+    state['file_chain'][-1]["new_indent"] = 1
+    write_line('else:', kind='condition')
+
+
+@command("nvl:", "^:(nvl):$")
+def _cmd_nvl(matches):
+    log("command: New NVL block", LOGLEVEL.DEBUG)
+    log("New indent is now expected", LOGLEVEL.VERB)
+    state['file_chain'][-1]["new_indent"] = 1
+    state['file_chain'][-1]["indents"].open_nvl()
+
+
+@command("clear", "^:(clear)$")
+def _cmd_clear(matches):
+    log("command: NVL clear", LOGLEVEL.DEBUG)
+    if nvl_mode():
+        write_line("nvl clear", kind='nvl_clear')
+    else:
+        write_line()
+
+
+@command("import", "^:(import)\s+(.*)$")
+def _cmd_import(matches):
+    log("command: Import new file for reading", LOGLEVEL.DEBUG)
+    _path = path.abspath(path.expanduser(path.expandvars(matches[0])))
+    if path.isfile(_path) is False:
+        log("{} is not an accessible file".format(
+            matches[0]), LOGLEVEL.ERROR)
+    _key = import_key(_path)
+    _chain = state["file_chain"]
+    if any(f["key"] == _key for f in _chain):
+        log("Import cycle: {}", LOGLEVEL.ERROR, args=(' -> '.join(
+            [trace_name(f["file_path"]) for f in _chain]+[trace_name(_path)]),))
+        return
+    if config["import_once"] and _key in state["imported"]:
+        log("{} is already imported; skipping it", LOGLEVEL.INFO,
+            args=(matches[0],))
+        record_import(_key, skipped=True)
+        return
+    log("Importing file {}".format(matches[0]), LOGLEVEL.INFO)
+    record_import(_key)
+    _t = state["trace"]
+    if _t:
+        _t.begin("import "+matches[0], "import", {"file": trace_name(_path)})
+    import_file(_path)
+    if _t:
+        _t.end()
+
+
+@command("file", "^:(file)\s+(.*)$")
+def _cmd_file(matches):
+    log("command: New output file", LOGLEVEL.DEBUG)
+    next_out_file(matches[0])
+
+
+@command("log", "^:(log)\s+(0|1|2|3|4|" \
+                "VERBOSE|DEBUG|INFO|WARN|WARNING|ERROR)\s+(.*)$")
+def _cmd_log(matches):
+    log("command: write to log", LOGLEVEL.VERB)
+    try:
+        log(matches[1], int(matches[0]))
+    except ValueError:
+        log(matches[1], eval("LOGLEVEL."+matches[0]))
+
+
+@command("config", "^:(config)\s+(.*?)\s*=\s*(.*)$")
+def _cmd_config(matches):
+    log("command: Congiguration setting", LOGLEVEL.DEBUG)
+    if matches[0] not in config:
+        log("Unknown config option {}".format(matches[0]), LOGLEVEL.ERROR)
+
+    if matches[0] == "flow_control_ignore":
+        _l = []
+        for v in eval(matches[1].replace(r'\"', '"')):
+            _l.append(re.compile('^'+regex_prep(v)+'$'))
+        config["flow_control_ignore"] = _l
+        record_definition("config", matches[0], [r.pattern for r in _l])
+
+    else:
         try:
-            log(matches[1], int(matches[0]))
-        except ValueError:
-            log(matches[1], eval("LOGLEVEL."+matches[0]))
+            config[matches[0]] = eval(matches[1])
+        except (SyntaxError, NameError):
+            config[matches[0]] = matches[1]
+        record_definition("config", matches[0], config[matches[0]])
 
-    # ^:(config)\s*(.*?)=\s?(.*)$
-    elif command == "config":
-        log("command: Congiguration setting", LOGLEVEL.DEBUG)
-        if matches[0] not in config:
-            log("Unknown config option {}".format(matches[0]), LOGLEVEL.ERROR)
 
-        if matches[0] == "flow_control_ignore":
-            _l = []
-            for v in eval(matches[1].replace(r'\"', '"')):
-                _l.append(re.compile('^'+regex_prep(v)+'$'))
-            config["flow_control_ignore"] = _l
+@command("config:", "^:(config:)$")
+def _cmd_config_block(matches):
+    log("command: Config block", LOGLEVEL.DEBUG)
+    _open_command_block('config')
 
-        else:
-            try:
-                config[matches[0]] = eval(matches[1])
-            except (SyntaxError, NameError):
-                config[matches[0]] = matches[1]
-
-    # ^:(config:)$
-    elif command == "config:":
-        log("command: Config block", LOGLEVEL.DEBUG)
-        log("New indent is now expected", LOGLEVEL.VERB)
-        _f["new_indent"] = 1
-        _f["command_block"] = True
-        _f["command"] = ('config', _re)
 
-    # ^:(break)$
-    elif command == "break":
-        log("Break command encountered", LOGLEVEL.INFO)
-        sys.exit()
+@command("break", "^:(break)$")
+def _cmd_break(matches):
+    log("Break command encountered", LOGLEVEL.INFO)
+    sys.exit()
 
 ##-----------------------------------------------------------------------------
 ## Per line functions
 ##-----------------------------------------------------------------------------
 
 def indentinator(leading_whitespace):
-    log("Performing indentation management", LOGLEVEL.VERB)
+    if log.enabled_for(LOGLEVEL.VERB):
+        log("Performing indentation management", LOGLEVEL.VERB)
     _f = state['file_chain'][-1]
-    prev_ws = _f["prev_whitespace"]
+    _indents = _f["indents"]
+    _top = _indents.widths[-1]
 
-    if leading_whitespace < sum(prev_ws):
+    if leading_whitespace < _top:
         _f["command_block"] = False
-        _reduce = 0
-        for i in range(len(prev_ws), 0, -1):
-            if leading_whitespace < sum(prev_ws[:i]):
-                _reduce += 1
-            else:
-                break
-
-        _f["cur_indent"] -= _reduce
-        while _reduce >= 1:
-            prev_ws.pop()
-            if state["is_nvl_mode"]:
-                state["is_nvl_mode"] -= 1
-                if state["is_nvl_mode"] == 0:
-                    state["is_nvl_mode"] = False
-            _reduce -= 1
-
-        if leading_whitespace != sum(prev_ws):
+        if not _indents.dedent(leading_whitespace):
             log("Inconsistent indentation detected", LOGLEVEL.ERROR)
+        _f["cur_indent"] = _indents.depth()
 
-    elif leading_whitespace > sum(prev_ws):
+    elif leading_whitespace > _top:
+        _indents.indent(leading_whitespace)
         _f["cur_indent"] += 1
-        prev_ws.append(leading_whitespace - sum(prev_ws))
-        if state["is_nvl_mode"]:
-            if state["is_nvl_mode"] is True:
-                state["is_nvl_mode"] = 1
-            else:
-                state["is_nvl_mode"] += 1
 
 
 def parse_line(line):
     stats["in_lines"] += 1
     _f = state["file_chain"][-1]
-    log('Parsing Line: "{}"'.format(line.strip()), LOGLEVEL.VERB)
+    _p = state["profile"]
+    _verb = log.enabled_for(LOGLEVEL.VERB)
+    if _verb:
+        log('Parsing Line: "{}"'.format(line.strip()), LOGLEVEL.VERB)
 
     if empty_line_re.match(line):
         write_line()
@@ -964,15 +3615,20 @@ def parse_line(line):
     if _m:
         line = _m.group(2).rstrip()
         if line[0] == config["copy_special_comments"]:
-            write_line(_m.group(1)+'#'+line, indent=False)
-        else:
+            write_line(_m.group(1)+'#'+line, indent=False, kind='comment')
+        elif _verb:
             log("Non-copy comment detected; skipping.", LOGLEVEL.VERB)
         return
 
+    if _p:
+        _p.switch("indent")
     indentinator(len(line) - len(line.lstrip()))
+    if _p:
+        _p.switch("parse")
     line = line.strip()
 
-    log("Checking for indentation errors", LOGLEVEL.VERB)
+    if _verb:
+        log("Checking for indentation errors", LOGLEVEL.VERB)
     if _f["new_indent"]:
         if _f["cur_indent"] <= _f["prev_indent"]:
             log("Expecting new indent", LOGLEVEL.ERROR)
@@ -983,78 +3639,79 @@ def parse_line(line):
     _f["prev_indent"] = _f["cur_indent"]
     _f["new_indent"] = 0
 
+    _line = line.replace('"', r'\"')
+
     # Inside command block
     if _f["command_block"]:
-        parse_command_block(line.replace('"', r'\"'))
+        parse_command_block(_line)
         return
 
     # Commands
-    log("Checking for command", LOGLEVEL.VERB)
-    for i in range(len(command_list)):
-        _m = command_list[i].match(line.replace('"', r'\"'))
-        if _m:
-            if _m.group(1) == ':' and line[-1] == ':':
+    if _verb:
+        log("Checking for command", LOGLEVEL.VERB)
+    _m = command_key_re.match(_line)
+    if _m:
+        keyword = _m.group(1)
+        if keyword == ':' and line[-1] == ':':
+            if _verb:
                 log("New indent is now expected", LOGLEVEL.VERB)
-                _f["new_indent"] = 1
-            parse_command(_m.group(1), _m.groups()[0:], command_list[i-1])
+            _f["new_indent"] = 1
+        if parse_command(keyword, _line):
             return
 
-    log("Checking for new indent", LOGLEVEL.VERB)
+    if _verb:
+        log("Checking for new indent", LOGLEVEL.VERB)
     if line[-1] == ':':
-        log("New indent is now expected", LOGLEVEL.VERB)
+        if _verb:
+            log("New indent is now expected", LOGLEVEL.VERB)
         _f["new_indent"] = 1
 
     # $ starting python lines
     _m = python_re.match(line)
     if _m:
         log("Python line command detected", LOGLEVEL.DEBUG)
-        write_line(_m.group(1))
+        write_line(_m.group(1), kind='python')
         return
 
-    line = line.replace('"', r'\"')
+    line = _line
 
     # Line replacement
-    log("Checking for line replacement", LOGLEVEL.VERB)
-    for k, v in state["known_line_rep"].items():
-        _m = k.match(line)
-        if _m:
+    if _verb:
+        log("Checking for line replacement", LOGLEVEL.VERB)
+    if _p:
+        _p.switch("line_rules")
+    _m = state["known_line_rep"].match(line)
+    if _m:
+        if _verb:
             log("Line replacement match", LOGLEVEL.VERB)
-            stats["line_replacements"] += 1
-            _s = re.sub('\\\\{|\\\\}', fix_brace, v)
-            _s = _s.format(*_m.groups())
-            try:
-                write_line(re.sub('\xc0|\xc1', fix_brace, _s))
-            except Exception as e:
-                raise
-                # log("Unable to replace line:\n  {}\n  {}".format(
-                #     v, _m.groups()), LOGLEVEL.ERROR)
-            return
+        stats["line_replacements"] += 1
+        write_line(_m[0].render(_m[1]), kind='replacement')
+        return
 
     # Character Replacement
-    log("Checking for character replacement", LOGLEVEL.VERB)
-    for k, v in state["known_character_rep"].items():
-        _m = k.match(line)
-        if _m:
+    if _verb:
+        log("Checking for character replacement", LOGLEVEL.VERB)
+    if _p:
+        _p.switch("character_rules")
+    _m = state["known_character_rep"].match(line)
+    if _m:
+        if _verb:
             log("Character replacement match", LOGLEVEL.VERB)
-            _s = re.sub('\\\\{|\\\\}', fix_brace, v[0])
-            if state["is_nvl_mode"]:
-                _n = config["nvl_prefix"]+_s+config["nvl_suffix"]
-                _line = ''.join((_n, v[1]))
-            else:
-                _line = ''.join(v)
-            stats["character_replacements"] += 1
-            stats["dialogue_lines"] += 1
-            try:
-                _line = _line.format(*_m.groups())
-                write_line(re.sub('\xc0|\xc1', fix_brace, _line))
-            except Exception as e:
-                raise
-                # log("Unable to replace prefix:\n  {}\n  {}".format(
-                #     v[0], _m.groups()), LOGLEVEL.ERROR)
-            return
+        if nvl_mode():
+            _line = _m[0].render(_m[1], config["nvl_prefix"],
+                                 config["nvl_suffix"])
+        else:
+            _line = _m[0].render(_m[1])
+        stats["character_replacements"] += 1
+        stats["dialogue_lines"] += 1
+        write_line(_line, kind='dialogue')
+        return
+    if _p:
+        _p.switch("parse")
 
     # Unknown command
-    log("Checking for unknown command", LOGLEVEL.VERB)
+    if _verb:
+        log("Checking for unknown command", LOGLEVEL.VERB)
     _m = command_re.match(line)
     if _m:
         # TODO: implement unknow command outputs
@@ -1069,17 +3726,152 @@ def parse_line(line):
         # return
 
     # Else, its just a normal narration line
-    log("Normal narration line", LOGLEVEL.VERB)
-    if state["is_nvl_mode"]:
+    if _verb:
+        log("Normal narration line", LOGLEVEL.VERB)
+    if nvl_mode():
         _nvl = config["nvl_character"]+' '
     else:
         _nvl = ''
 
     stats["narration_lines"] += 1
     if line[-1] == ':':
-        write_line(_nvl+'"{}":'.format(line[:-1]))
+        write_line(_nvl+'"{}":'.format(line[:-1]), kind='narration')
     else:
-        write_line(_nvl+'"{}"'.format(line))
+        write_line(_nvl+'"{}"'.format(line), kind='narration')
+
+##-----------------------------------------------------------------------------
+## Builder API
+##-----------------------------------------------------------------------------
+
+class Build_Error(Exception):
+    """Raised by a `Builder` when a script fails to compile."""
+
+
+class Builder(object):
+    """Compiles scripts from Python, without touching the output directory.
+
+    Every builder has its own state, config, stats and logger, which are
+    swapped in for the module globals only while it is working. So any
+    number of builders can be used in one process, one after another or
+    interleaved, but not from several threads at once. Imported files are
+    still read from disk, relative to the current directory.
+
+    The warnings and errors of the last build, or with `debug` set its
+    debug messages too, are kept in `log.records` as `(level, message)`
+    pairs; nothing is printed.
+
+        builder = Builder()
+        for out_file, line in builder.compile_string(source):
+            ...
+    """
+
+    def __init__(self, debug=0):
+        global _debug
+        _old_debug, _debug = _debug, debug
+        try:
+            self.log = _Logger([], quiet=True, keep=True)
+        finally:
+            _debug = _old_debug
+        self.state = dict(state, **{
+            "open_files": File_Registry(),
+            "file_chain": [],
+            "parent_labels": set(),
+            "imported": set(),
+            "manifest": None,
+            "recorders": [],
+            "file_hashes": {},
+            "input_stamps": {},
+            "parallel_builds": {},
+            "pool": None,
+            "watch": False,
+            "building": False,
+            "stream": deque(),
+            "ir": Script_IR(),
+            "preludes": None,
+            "labels": Label_Table(),
+            # Not the command line options of whatever process embeds it
+            "profile": None,
+            "cprofile": None,
+            "trace": None,
+            "rule_heat": None,
+            "check": None,
+        })
+        self.config = dict(_config_defaults)
+        self.stats = dict(stats)
+        self.__saved = None
+
+    def __activate(self):
+        global state, config, stats, log
+        self.__saved = (state, config, stats, log)
+        state, config, stats, log = (self.state, self.config, self.stats,
+                                     self.log)
+
+    def __deactivate(self):
+        global state, config, stats, log
+        state, config, stats, log = self.__saved
+        self.__saved = None
+
+    def __step(self, func, *args):
+        """Run `func` with this builder's globals.
+
+        Returns False if the script asked for the build to stop.
+        """
+        self.__activate()
+        try:
+            func(*args)
+        except SystemExit as e:
+            if e.code:
+                raise Build_Error(self.log.last_error or
+                                  "Build aborted with code {}".format(e.code))
+            return False
+        finally:
+            self.__deactivate()
+        return True
+
+    def __drain(self):
+        _stream = self.state["stream"]
+        while _stream:
+            yield _stream.popleft()
+
+    def __start(self, file_path):
+        reset_build(dict(_config_defaults,
+                         flow_control_ignore=default_flow_control_ignore()))
+        state["file_hashes"] = {}
+        state["stream"].clear()
+        stats["in_files"] += 1
+        push_file_chain(None, file_path)
+
+    def __parse(self, line):
+        _f = state["file_chain"][-1]
+        _f["cur_line"] += 1
+        parse_line(line)
+        flush_ir()
+
+    def __finish(self):
+        finish_build()
+
+    def compile_stream(self, lines, name="script.rps"):
+        """Compile the script `lines`, yielding `(out_file, line)` pairs.
+
+        `name` stands in for the script's file name, which decides the name
+        of the default output file. Output is yielded as soon as it is
+        produced. Raises `Build_Error` if the script has an error and
+        `abort_on_error` is set.
+        """
+        self.__step(self.__start, path.abspath(name))
+        for line in lines:
+            _go_on = self.__step(self.__parse, line)
+            for out in self.__drain():
+                yield out
+            if not _go_on:
+                break
+        self.__step(self.__finish)
+        for out in self.__drain():
+            yield out
+
+    def compile_string(self, source, name="script.rps"):
+        """Compile the script text `source`, like `compile_stream`."""
+        return self.compile_stream(source.splitlines(True), name)
 
 ##-----------------------------------------------------------------------------
 ## Main execution
@@ -1093,16 +3885,22 @@ def main(argv):
     if '-h' in argv or '--help' in argv:
         usage()
 
-    if len(argv) > 1:
-        try:
-            opts, args = getopt.getopt(argv[1:], 'ho:',
-                ['help', 'output=', 'debug', 'verbose'])
-        except getopt.GetoptError as e:
-            usage(str(e))
-    else:
-        opts, args = {}, {}
+    # --profile takes an optional value, which getopt can't handle
+    argv = [a if a != '--profile' else '--profile=phases' for a in argv]
+    try:
+        opts, args = getopt.gnu_getopt(argv, 'ho:j:',
+            ['help', 'output=', 'debug', 'verbose', 'jobs=', 'watch',
+             'profile=', 'trace=', 'check'])
+    except getopt.GetoptError as e:
+        usage(str(e))
+    if not args:
+        usage("No input script file defined.")
 
     output_path = None
+    jobs = None
+    profile = None
+    trace = None
+    check = False
     _debug = 0
 
     if opts:
@@ -1113,6 +3911,21 @@ def main(argv):
     for opt, arg in opts:
         if opt in ('-o', '--output'):
             output_path = arg
+        elif opt == '--watch':
+            state["watch"] = True
+        elif opt == '--check':
+            check = True
+        elif opt == '--profile':
+            if arg not in ('phases', 'cprofile'):
+                usage("Invalid profile mode: {}".format(arg))
+            profile = arg
+        elif opt == '--trace':
+            trace = path.abspath(arg)
+        elif opt in ('-j', '--jobs'):
+            try:
+                jobs = int(arg) or cpu_count()
+            except ValueError:
+                usage("Invalid number of jobs: {}".format(arg))
         elif opt == '--debug':
             if _debug:
                 log("Can not set --debug and --verbose options simultaniously",
@@ -1130,10 +3943,21 @@ def main(argv):
                     "and performance of the script and may result in a huge "
                     "log file.", LOGLEVEL.WARN)
 
-    in_file = path.abspath(path.expanduser(path.expandvars(argv[0])))
+    in_files = expand_inputs(args)
+    if not in_files:
+        usage("No input script file matches {}".format(' '.join(args)))
+    if check and state["watch"]:
+        usage("--check and --watch can't be used together")
+    if len(in_files) > 1:
+        if state["watch"] or profile or trace:
+            usage("--watch, --profile and --trace take a single source file")
+        batch_build(in_files, output_path, jobs or cpu_count(), check)
+        sys.exit(1 if log.counts()[1] else 0)
+    in_file = in_files[0]
+    jobs = jobs or 1
 
     if path.isfile(in_file) is False:
-        log("{} is not an accessible file".format(argv[0]),
+        log("{} is not an accessible file".format(args[0]),
             LOGLEVEL.ERROR, exit = False)
         try:
             log("initializing logger", LOGLEVEL.DEBUG)
@@ -1146,23 +3970,226 @@ def main(argv):
 
     os.chdir(path.dirname(in_file))
 
-    setup_globals(output_path)
-
-    loop_file(in_file)
+    setup_globals(output_path, save_log=not check)
+    if check:
+        state["check"] = []
+    _config = dict(config)
+    state["building"] = True
+
+    if profile == 'cprofile':
+        import cProfile
+        state["cprofile"] = cProfile.Profile()
+        state["cprofile"].enable()
+    elif profile:
+        state["profile"] = Phase_Timer()
+    if trace:
+        state["trace"] = Build_Trace(trace)
+        state["trace"].begin("build", "build", {"file": trace_name(in_file)})
+
+    if jobs > 1:
+        plan_parallel_build(in_file, jobs)
+
+    if state["watch"]:
+        watched_build(in_file)
+        watch(in_file, _config)
+    else:
+        build_file(in_file)
 
     sys.exit()
 
 
-def cleanup():
-    log("Cleaning up", LOGLEVEL.VERB)
+def reset_build(base_config=None):
+    """Reset the build state, ready to build from scratch again.
+
+    The rule sets start out empty, but the regexes compiled for them are
+    kept, as are the input file hashes and the build manifest.
+    """
+    state.update({
+        "master_in_file": None,
+        "cur_in_file": None,
+        "cur_out_file": None,
+        "next_out_file": None,
+        "control_file": None,
+        "open_files": File_Registry(),
+        "known_line_rep": Rule_Set('$'),
+        "known_character_rep": Character_Rule_Set(),
+        "file_chain": [],
+        "parent_labels": set(),
+        "imported": set(),
+        "recorders": [],
+        "parallel_builds": {},
+        "pool": None,
+        "building": True,
+        "aborted": False,
+        "ir": Script_IR(),
+        "labels": Label_Table(),
+    })
+    if state["profile"]:
+        state["profile"] = Phase_Timer()
+    if state["cprofile"]:
+        state["cprofile"].enable()
+    if base_config is not None:
+        config.clear()
+        config.update(base_config)
+    for k in stats:
+        stats[k] = 0
+    stats["start_time"] = time.time()
+    log.reset_counts()
+
+
+def watch(in_file, base_config, interval=0.05):
+    """Rebuild `in_file` whenever one of the files it was built from changes.
+
+    Changes are found by polling the modification time of every input file
+    of the last build. A rebuild starts from the master file, but imports
+    that are unchanged are replayed from the in memory build manifest.
+    """
+    log("Watching for changes. Press Ctrl+C to stop.", LOGLEVEL.INFO)
+    try:
+        while True:
+            time.sleep(interval)
+            _changed = [p for p, s in state["input_stamps"].items()
+                        if file_stamp(p) != s]
+            if not _changed:
+                continue
+
+            for p in _changed:
+                state["input_stamps"][p] = file_stamp(p)
+                state["file_hashes"].pop(p, None)
+            log("{} changed; rebuilding", LOGLEVEL.INFO,
+                args=(', '.join(p.replace(os.getcwd(), '.')
+                                for p in _changed),))
+
+            reset_build(base_config)
+            if state["trace"]:
+                state["trace"].begin("build", "build",
+                                     {"file": trace_name(in_file)})
+            watched_build(in_file)
+    except KeyboardInterrupt:
+        log("Stopped watching", LOGLEVEL.INFO)
+
+
+def watched_build(in_file):
+    """Build `in_file` in watch mode, where an error ends the build but not
+    the builder, which goes on to wait for the fix."""
+    try:
+        try:
+            build_file(in_file)
+        except Exception:
+            log.log_traceback()
+    except SystemExit:
+        pass
+    finish_build()
+    log.close()
+
+
+def build_file(in_file):
+    """Build the master file `in_file`.
+
+    The build counts as aborted until it runs to the end or a script stops
+    it on purpose, so after an error, an exception or Ctrl+C the output
+    files on disk are left as they were.
+    """
+    state["aborted"] = True
+    try:
+        loop_file(in_file)
+    except SystemExit as e:
+        if not e.code:
+            state["aborted"] = False
+        raise
+    state["aborted"] = False
+
+
+def finish_build():
+    """Write out everything still pending and close the output files, or
+    discard the output if the build was aborted."""
+    log("Finishing build", LOGLEVEL.VERB)
+    if state["aborted"]:
+        finish_aborted_build()
+        return
+    if config["create_flow_control_file"]:
+        for _f in state["file_chain"]:
+            write_label_call(_f)
+    flush_ir()
+    if config["check_labels"] and not (config["abort_on_error"]
+                                       and log.counts()[1]):
+        state["labels"].check()
     if state["control_file"]:
-        write_line("return", False, state["control_file"])
-    for f in state['open_files']:
+        state["control_file"].write("return\n")
+        stats["out_lines"] += 1
+    _save = state["stream"] is None and state["check"] is None
+    if state["manifest"] and config["incremental_build"] and _save:
+        state["manifest"].save()
+    if state["preludes"] and _save:
+        state["preludes"].save()
+    if config["adaptive_rule_order"] and _save:
+        save_rule_heat()
+    if state["pool"]:
+        for _builds in state["parallel_builds"].values():
+            for _future in _builds:
+                _future.cancel()
+        state["pool"].shutdown()
+        state["pool"] = None
+    if state["profile"]:
+        state["profile"].switch("output")
+    _t = state["trace"]
+    for f in state['open_files'] or ():
+        if _t:
+            _t.begin("close "+trace_name(f.name), "output")
         try:
-            f.close()
+            _written = f.close()
         except ValueError:
-            pass
+            _written = False
+        if _t:
+            _t.end({"written": _written})
+    if state["check"]:
+        log("{} of {} output files are out of date:\n    {}", LOGLEVEL.ERROR,
+            exit=False, args=(len(state["check"]), len(state["open_files"]),
+            '\n    '.join(trace_name(p) for p in sorted(state["check"]))))
+    elif state["check"] is not None:
+        log("All {} output files are up to date", LOGLEVEL.INFO,
+            args=(len(state["open_files"]),))
+    state["open_files"] = File_Registry()
+    state["control_file"] = None
+    state["building"] = False
+    if state["profile"]:
+        state["profile"].stop()
+    save_profile()
+    if _t:
+        _t.save()
+
+
+def finish_aborted_build():
+    """Discard the output of an aborted build and close it down."""
+    log("Build aborted; keeping the previous output files", LOGLEVEL.INFO)
+    if state["pool"]:
+        for _builds in state["parallel_builds"].values():
+            for _future in _builds:
+                _future.cancel()
+        state["pool"].shutdown()
+        state["pool"] = None
+    for f in state['open_files'] or ():
+        f.discard()
+    state["open_files"] = File_Registry()
+    state["control_file"] = None
+    state["aborted"] = False
+    state["building"] = False
+    if state["profile"]:
+        state["profile"].stop()
+    save_profile()
+    if state["trace"]:
+        state["trace"].save()
+
+
+def cleanup():
+    log("Cleaning up", LOGLEVEL.VERB)
+    if state["watch"] and not state["building"]:
+        # Every build has been finished off already
+        return
+    finish_build()
     log.close()
+    if state["check"]:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
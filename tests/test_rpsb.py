@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for rpsb.py. Run with "python -m pytest tests" or
+"python -m unittest discover tests" from the repository root.
+"""
+from __future__ import print_function, unicode_literals
+
+import os
+import sys
+import io
+import time
+import signal
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, _root)
+import rpsb
+
+RPSB = os.path.join(_root, 'rpsb.py')
+
+
+def compile_lines(source, builder=None):
+    """Compile `source` with a fresh `Builder`, returning the lines of each
+    output file."""
+    _out = {}
+    for name, line in (builder or rpsb.Builder()).compile_string(source):
+        _out.setdefault(name, []).append(line)
+    return _out
+
+
+class Temp_Dir_Test(unittest.TestCase):
+    """Runs each test in a temporary working directory."""
+
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        with io.open(name, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    def read(self, name):
+        with io.open(name, encoding='utf-8') as f:
+            return f.read()
+
+    def run_rpsb(self, *args):
+        """Run rpsb.py on the command line, returning its exit code."""
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call([sys.executable, RPSB] + list(args),
+                                   stdout=devnull, stderr=devnull)
+
+    def outputs(self):
+        """Return the contents of every file but the scripts and the log."""
+        return dict((name, self.read(name)) for name in os.listdir('.')
+                    if not name.endswith(('.rps', '.log')))
+
+
+class Rule_Set_Test(Temp_Dir_Test):
+
+    def test_many_rules_stay_under_group_limit(self):
+        _source = ':line:\n' + ''.join(
+            '    Say{{*}} rule {0} = Said {{}} {0}\n'.format(i)
+            for i in range(200))
+        _source += '::a\nSayhi rule 150\nSayyo rule 3\n'
+        _out = compile_lines(_source)
+        self.assertEqual(_out["script.rpy"],
+                         ['label a:', 'Said hi 150', 'Said yo 3'])
+        self.assertTrue(all(r.groups <= rpsb._max_groups
+                            for r in rpsb._regex_cache.values()))
+
+
+class Builder_Test(Temp_Dir_Test):
+
+    def test_debug_keeps_debug_records(self):
+        _builder = rpsb.Builder(debug=True)
+        compile_lines('::a:\n    Hi.\n', _builder)
+        _levels = set(level for level, _ in _builder.log.records)
+        self.assertIn(rpsb.LOGLEVEL.DEBUG, _levels)
+
+    def test_default_keeps_problems_only(self):
+        _builder = rpsb.Builder()
+        compile_lines(':config abort_on_error = False\n::a:\n    Hi.\n'
+                      '        Not expecting an indent.\n', _builder)
+        self.assertTrue(_builder.log.records)
+        self.assertTrue(all(level >= rpsb.LOGLEVEL.WARN
+                            for level, _ in _builder.log.records))
+
+
+class Phase_Timer_Test(unittest.TestCase):
+
+    def test_results_only_read_the_timings(self):
+        _timer = rpsb.Phase_Timer()
+        _timer.switch("input")
+        time.sleep(0.01)
+        _timer.stop()
+        _results = _timer.results()
+        time.sleep(0.01)
+        self.assertEqual(_timer.results(), _results)
+        self.assertEqual(_timer.report(), _timer.report(_results))
+
+
+class Label_Check_Test(Temp_Dir_Test):
+
+    def test_messages_give_file_and_line(self):
+        _builder = rpsb.Builder()
+        compile_lines(':config check_labels = True\n::a:\n    :j nowhere\n'
+                      '::a:\n    Hi.\n', _builder)
+        _messages = sorted(msg for _, msg in _builder.log.records)
+        self.assertEqual(_messages, [
+            'script.rps|3 Jump to undefined label nowhere',
+            'script.rps|4 Label a is already defined at script.rps|2'])
+
+
+GOOD_SCRIPT = """\
+:config max_open_files = 1
+::a:
+    Hi.
+:file other.rpy
+::b:
+    Yo.
+"""
+
+# Changes both output files, then fails after they were written to
+BAD_SCRIPT = """\
+:config max_open_files = 1
+::a:
+    Changed.
+:file other.rpy
+::b:
+    Changed too.
+::c:
+    Fine.
+        Not expecting an indent.
+"""
+
+
+class Aborted_Build_Test(Temp_Dir_Test):
+
+    def test_aborted_build_keeps_old_output(self):
+        self.write('script.rps', GOOD_SCRIPT)
+        self.assertEqual(self.run_rpsb('script.rps'), 0)
+        _good = self.outputs()
+        self.assertEqual(sorted(_good),
+                         ['control.rpy', 'other.rpy', 'script.rpy'])
+
+        self.write('script.rps', BAD_SCRIPT)
+        self.assertEqual(self.run_rpsb('script.rps'), 1)
+        self.assertEqual(self.outputs(), _good)
+
+
+class Watch_Test(Temp_Dir_Test):
+
+    def wait_for(self, text, timeout=20):
+        """Wait until `text` shows up in the log."""
+        _end = time.time()+timeout
+        while time.time() < _end:
+            if os.path.isfile('rpsb.log') and text in self.read('rpsb.log'):
+                return
+            time.sleep(0.1)
+        self.fail("rpsb.py never logged {!r}".format(text))
+
+    def test_failing_edit_keeps_old_output(self):
+        self.write('script.rps', GOOD_SCRIPT)
+        _devnull = open(os.devnull, 'w')
+        _process = subprocess.Popen([sys.executable, RPSB, 'script.rps',
+                                     '--watch'], stdout=_devnull,
+                                    stderr=_devnull)
+        try:
+            self.wait_for("Watching for changes")
+            _good = self.outputs()
+            self.assertEqual(sorted(_good),
+                             ['control.rpy', 'other.rpy', 'script.rpy'])
+
+            # Make sure the edit gets a new modification time
+            time.sleep(1.1)
+            self.write('script.rps', BAD_SCRIPT)
+            self.wait_for("Build failed")
+            self.assertEqual(self.outputs(), _good)
+        finally:
+            _process.send_signal(signal.SIGINT)
+            _process.wait()
+            _devnull.close()
+
+
+
+class Replayed_Import_Test(Temp_Dir_Test):
+
+    def rule_report(self, name='Line'):
+        """Return the rule report called `name` from the last build's log.
+        """
+        _title = name+' rules:'
+        _log = self.read('rpsb.log').split('\n')
+        _start = [i for i, l in enumerate(_log) if _title in l][0]
+        _report = [_log[_start].split(_title)[1]]
+        for line in _log[_start+1:]:
+            if not line.startswith('    '):
+                break
+            _report.append(line)
+        return _report
+
+    def test_replayed_rules_keep_their_source(self):
+        self.write('main.rps', ':config incremental_build = True\n'
+                   ':import chapter.rps\n')
+        self.write('chapter.rps', ':line Greet {+} = Hello {}\n'
+                   '::ch:\n    Greet Ann\n')
+        self.assertEqual(self.run_rpsb('main.rps'), 0)
+        self.assertEqual(self.run_rpsb('main.rps'), 0)
+        self.assertIn('reusing previous build', self.read('rpsb.log'))
+        self.assertIn(': Greet {+}', self.rule_report()[1])
+
+    def test_rule_reports_match_fresh_builds(self):
+        self.write('main.rps', ':config incremental_build = True\n'
+                   ':line Greet {+} = Hello {}\n'
+                   ':character A{?} = a{}\n'
+                   ':import chapter.rps\n:import chapter2.rps\n'
+                   '::end:\n    Greet Bob\n')
+        self.write('chapter.rps', '::ch:\n    Greet Ann\n    Ax Hi.\n')
+        self.write('chapter2.rps', ':line Farewell {+} = Bye {}\n'
+                   '::ch2:\n    Greet Cy\n    Farewell Cy\n    Ay Yo.\n')
+
+        def _reports():
+            return self.rule_report('Line'), self.rule_report('Character')
+
+        self.assertEqual(self.run_rpsb('main.rps'), 0)
+        _fresh = _reports()
+        self.assertIn(': Farewell {+}', _fresh[0][2])
+
+        self.assertEqual(self.run_rpsb('main.rps'), 0)
+        self.assertIn('reusing previous build', self.read('rpsb.log'))
+        self.assertEqual(_reports(), _fresh)
+
+        os.remove('.rpsb-manifest.json')
+        self.assertEqual(self.run_rpsb('main.rps', '-j', '2'), 0)
+        self.assertEqual(_reports(), _fresh)
+
+
+if __name__ == '__main__':
+    unittest.main()